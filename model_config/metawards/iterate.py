@@ -2,40 +2,14 @@
 # Lock-down iterator that simulates various control measures for Covid-19
 #
 
-from datetime import datetime
 from metawards.utils import Console
+from uq4metawards.lockdown import get_lockdown_schedule
 
 
 # Determine the lock-down status based on the population and current network
-# TODO: Now MetaWards accepts dates, so we might be able to simplify this
+# The schedule is compiled from the user parameters on the first day of each run, see uq4metawards.lockdown
 def get_lock_down_vars(network, population):
-
-    date = population.date
-    params = network.params.user_params
-
-    y1 = int(params["lockdown_date_1_year"])
-    m1 = int(params["lockdown_date_1_month"])
-    d1 = int(params["lockdown_date_1_day"])
-
-    y2 = int(params["lockdown_date_2_year"])
-    m2 = int(params["lockdown_date_2_month"])
-    d2 = int(params["lockdown_date_2_day"])
-
-    # Lock down dates
-    lock_1 = datetime(y1, m1, d1).date()
-    lock_2 = datetime(y2, m2, d2).date()
-    
-    state = 0
-    rate = 1.0
-    if date >= lock_1:
-        state += 1
-        rate = params["lock_1_restrict"]
-    if date >= lock_2:
-        state += 1
-        rate = (1.0 - ((1.0 - params["lock_1_restrict"]) * params["lock_2_release"]))
-
-    can_work = params["can_work"][state]
-    return state, rate, can_work
+    return get_lockdown_schedule(network, population).lookup(population.day)
 
 
 #
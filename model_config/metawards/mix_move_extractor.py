@@ -4,33 +4,42 @@
 import metawards
 from metawards.utils import call_function_on_network
 from metawards.utils import Console
-from multiprocessing import Lock
 from typing import List, Union
 from sqlite3 import OperationalError, Connection, Cursor, connect
 from sys import argv
 from os import path
 from csv import reader
+from uq4metawards.sql import ShardSink, make_array_results_schema, shard_file_name
+from uq4metawards.channels import ChannelSet, describe_source
+from uq4metawards.writebehind import WriteBehind
+from functools import partial
+import numpy as np
+import atexit
 
 _sql_file_name: str = ""
-_run_index: int = -1  # Which run this currently is
 
-# This is a bit dodgy as we use eval(), but skirts import/unresolved object errors for now
-# TODO: Write mini data_src functional objects that wrap the workspace to resolve this
+# Database writes happen on a background thread, one per process, see uq4metawards.sql.ShardSink
+_writer: Union[WriteBehind, None] = None
+_max_pending_days: int = 8
+
+# Rows are written every _flush_days days and at the end of each run
+_flush_days: int = 10
+
+# Set .array_schema to store one packed row of every ward per (run, day, channel), see uq4metawards.sql
+_array_schema: bool = False
+
+# Where each output channel comes from: a workspace array or a (demographic, stage) pair, see uq4metawards.channels
 _output_channels_list = \
     {
-        "susceptible": ["workspace.S_in_wards"],
-        "exposed": ["workspace.E_in_wards"],
-        "infected": ["get_comp(network, workspace, \"genpop\", 3)"],
-        "deaths": ["get_comp(network, workspace, \"morgue\", 4)"],
-        "recovered": ["get_comp(network, workspace, \"genpop\", 4)"]
+        "susceptible": "S_in_wards",
+        "exposed": "E_in_wards",
+        "infected": ("genpop", 3),
+        "deaths": ("morgue", 4),
+        "recovered": ("genpop", 4)
     }
 
-
-# Index a compartment
-def get_comp(network, workspace, demographic, stage):
-    demo_index = network.demographics.get_index(demographic)
-    results = workspace.subspaces[demo_index]
-    return results.ward_inf_tot[stage]
+# Accessors for the channels above, built at the start of each run
+_channels: Union[ChannelSet, None] = None
 
 
 # Horrible hack to get access to input file argument not available in the extractor
@@ -52,7 +61,7 @@ def get_design_data() -> (List[str], List[List[str]]):
 # Makes the sql database
 # We can pass strings to metawards, so this can be removed at some point
 # TODO: Look into removing this (make template schema and copy) - environment variables might work?
-def make_sql_template(out_connection: Connection):
+def make_sql_template(out_connection: Connection, array_schema: bool = False):
     header, data = get_design_data()
     design_names = [var[1:] for var in header[:-1] if var[0] == '.']
     column_indices = [i for i, s in enumerate(header[:-1]) for name in design_names if name in s]
@@ -106,7 +115,10 @@ def make_sql_template(out_connection: Connection):
         cursor.execute(output_channel_schema)
         cursor.execute(day_table_schema)
         cursor.execute(run_table_schema)
-        cursor.execute(results_table_schema)
+        if array_schema:
+            cursor.execute(make_array_results_schema(output_table_name, day_table_name, run_table_name))
+        else:
+            cursor.execute(results_table_schema)
 
         # Global writes
 
@@ -133,6 +145,7 @@ def make_sql_template(out_connection: Connection):
 def extractor_setup(network: metawards.Network, **kwargs):
     # Globals
     global _sql_file_name
+    global _array_schema
 
     # Get the unique output directory for this run
     out_object: metawards.OutputFiles = kwargs["output_dir"]
@@ -141,63 +154,51 @@ def extractor_setup(network: metawards.Network, **kwargs):
 
     # Identify the design point
     design_index = int(network.params.user_params["design_index"])
+    _array_schema = bool(network.params.user_params.get("array_schema", False))
 
     # Create a valid URI to use the SQLite access rights
-    data_base_file_name: str = path.join(out_folder, "sql_wards.dat")
+    # Each worker process writes to its own shard, these are merged with uq4metawards-merge after the ensemble
+    data_base_file_name: str = shard_file_name(out_folder)
     _sql_file_name = data_base_file_name
     fixed_path = path.abspath(data_base_file_name).replace("\\", "/")
     db_uri = f"file:{fixed_path}?mode=rw"
 
-    # Concurrency guard: multiple processes can connect, but only one should create
+    # Nothing else writes to this shard, so the first run in each process creates it
     # NOTE: Connections only fail if the file doesn't exist with mode "rw"
     test_connection: Union[Connection, None] = None
     create_connection: Union[Connection, None] = None
 
-    # One at a time here
-    mutex = Lock()
-    with mutex:
-        try:
-            test_connection = connect(db_uri, uri=True)
-            # TODO: What do we do if there is an old database in there?
-            # FIXME: For re-running partial ensembles this needs to be handled
-        except OperationalError:
-            # This process is the first one in to create the database
-            try:
-                # Append "c" to make the connection create a blank database
-                create_connection = connect(db_uri + "c", uri=True)
-            except OperationalError as err:
-                # An actual problem happened if we get here
-                Console.print("SQL Error: " + str(err))
-                raise
-            make_sql_template(create_connection)
-        finally:
-            if test_connection:
-                test_connection.close()
-            if create_connection:
-                create_connection.close()
-
-        # Do first commits for setting up the run
-        # TODO: Preserve connection across scope
-        process_connection = connect(_sql_file_name)
+    try:
+        test_connection = connect(db_uri, uri=True)
+        # TODO: What do we do if there is an old database in there?
+        # FIXME: For re-running partial ensembles this needs to be handled
+    except OperationalError:
+        # This is the first run in this process, so the shard needs creating
         try:
-            write_setup_entries(process_connection, design_index, run_ident)
-        finally:
-            if process_connection:
-                process_connection.close()
+            # Append "c" to make the connection create a blank database
+            create_connection = connect(db_uri + "c", uri=True)
+        except OperationalError as err:
+            # An actual problem happened if we get here
+            Console.print("SQL Error: " + str(err))
+            raise
+        make_sql_template(create_connection, _array_schema)
+    finally:
+        if test_connection:
+            test_connection.close()
+        if create_connection:
+            create_connection.close()
 
+    # Register the run, this goes through the writer like everything else that touches the shard
+    get_writer().submit(ShardSink.start_run, design_index, run_ident, _array_schema, _flush_days)
 
-# Setup entries which are written once per run
-def write_setup_entries(database: Connection, design_index: int, run_ident: str):
-    global _run_index
-    c: Cursor = database.cursor()
 
-    # Write this run
-    i_str = f"insert into run_table(design_index,end_day,mw_folder) values (?,?,?)"
-    vals = (design_index, -1, run_ident)
-    c.execute(i_str, vals)
-    _run_index = c.lastrowid
-    Console.print("This is run: " + str(_run_index))
-    database.commit()
+# The background writer for this process, started on first use
+def get_writer() -> WriteBehind:
+    global _writer
+    if _writer is None:
+        _writer = WriteBehind(partial(ShardSink, _sql_file_name, Console.print), _max_pending_days)
+        atexit.register(_writer.close)
+    return _writer
 
 
 #
@@ -205,50 +206,46 @@ def write_setup_entries(database: Connection, design_index: int, run_ident: str)
 #
 def output_wards_serial(network: metawards.Network, population: metawards.Population,
                         workspace: metawards.Workspace, **kwargs):
-    global _sql_file_name
-    global _run_index
+    global _flush_days
+    global _channels
 
     # Potential problem: what if we accidentally hit a real attribute?
     if not hasattr(network.params, "_uq4covid_setup"):
         network.params._uq4covid_setup = True
+        _flush_days = max(1, int(network.params.user_params.get("flush_days", _flush_days)))
         extractor_setup(network, **kwargs)
+        _channels = ChannelSet(_output_channels_list, network)
 
-    # Prepare database entries
-    database = connect(_sql_file_name)
-    c: Cursor = database.cursor()
-
-    # Write the current day, some may be longer / shorter, so ignore duplicate entries
-    c.execute(f"insert or ignore into day_table(day,date) values (?,?)", (int(population.day), str(population.date)))
-    database.commit()
-
-    # Write results for infections and removed
-    # NOTE: Don't re-use time_index as if there is a duplicate then the rowid will be zero
-    # TODO: List comprehension is fine, but consider numpy (or equivalent) for more speed
-
-    output_src = 0
     mode_str = "normal write"
 
-    # The index has already been sent to the database, so reuse it here safely
-    for channel_index, channel_name in enumerate(_output_channels_list.keys()):
+    # The run index is held by the writer, which sees the days in the same order as they are submitted
+    # Only a copy of the workspace is handed over, the writer serialises it while the model runs the next day
+    sources: List[np.ndarray] = []
+    for channel_index, channel_name in enumerate(_channels.names):
         Console.print(f"Writing channel {channel_name} to database src = "
-                      f"{_output_channels_list[channel_name][output_src]}: {mode_str}")
-        data_source = eval(_output_channels_list[channel_name][output_src])
-        values = [(i, channel_index, x, int(population.day), _run_index)
-                  for i, x in enumerate(data_source) if i != 0]
-        c.executemany(f"insert into results_table(ward_id,output_channel,sim_out,sim_time,run_id) "
-                      f"values (?,?,?,?,?)", values)
+                      f"{describe_source(_channels.sources[channel_index])}: {mode_str}")
+        sources.append(_channels.read(channel_index, workspace))
+    get_writer().submit(ShardSink.add_day, int(population.day), str(population.date), np.stack(sources))
 
-    # Write last day into run table
-    c.execute("update run_table set end_day = ? where run_index = ?", (int(population.day), _run_index))
 
-    database.commit()
-    database.close()
+# Called once the run has finished, makes sure nothing is left in the buffers before the run is closed
+def finalise_wards_serial(**kwargs):
+    if _writer is not None:
+        _writer.submit(ShardSink.flush)
+        _writer.wait()
 
 
 # NOTE: We test for setup by sticking a flag to the network
 # TODO: Find a better solution
-def extract(**kwargs) -> List[metawards.utils.MetaFunction]:
-    return [output_wards_serial]
+# Taking "stage" means every stage comes here, a day is written once it has been analysed and the run's rows are
+# flushed to the shard when it finalises
+def extract(stage: str, **kwargs) -> List[metawards.utils.MetaFunction]:
+    if stage == "analyse":
+        return [output_wards_serial]
+    elif stage == "finalise":
+        return [finalise_wards_serial]
+    else:
+        return []
 
 
 def output_wards_i(nthreads: int = 1, **kwargs):
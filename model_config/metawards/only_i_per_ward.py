@@ -1,11 +1,14 @@
 # This is an extractor for MetaWards that exposes the standard parameters + I for each ward
 #
 # NOTE: If you use the "large" extractor you get this plus the other ward data that can clutter
+# Set .binary_trajectory = True to write wards_trajectory_I.bin instead of the CSV, see uq4metawards.trajectory
 #
 
 
 import metawards
+from functools import partial
 from typing import List
+from uq4metawards.trajectory import write_trajectory_header, write_trajectory_day
 
 
 # This needs to be the same as "extract_" + this script file name without the py extension
@@ -28,7 +31,6 @@ def output_wards_i_serial(network: metawards.Network, population: metawards.Popu
 
     d_vars = network.params.disease_params
     u_vars = network.params.user_params
-    infect_file = output_dir.open(f"wards_trajectory{name}_I.csv")
 
     # Just print the design parameters: 
     head_str = "beta[2],beta[3],progress[1],progress[2],progress[3],.scale_rate[1],.scale_rate[2]"
@@ -36,6 +38,18 @@ def output_wards_i_serial(network: metawards.Network, population: metawards.Popu
     design_out = [d_vars.beta[2], d_vars.beta[3], d_vars.progress[1], d_vars.progress[2], d_vars.progress[3]]
     design_out += [u_vars["lock_1_restrict"], u_vars["lock_2_release"]]
 
+    # Binary records: the design and ward count go in the header (written when the file is opened), then each day
+    # is the raw I_in_wards array
+    # NOTE: This is not compressed so that it can be appended to cheaply, bzip the run folders afterwards if needed
+    if u_vars.get("binary_trajectory", False):
+        infect_file = output_dir.open(f"wards_trajectory{name}_I.bin", auto_bzip=False, mode="b",
+                                      headers=partial(write_trajectory_header, n_values=len(workspace.I_in_wards),
+                                                      first_day=population.day, first_date=population.date,
+                                                      design_names=head_str.split(","), design_values=design_out))
+        write_trajectory_day(infect_file, population.day, workspace.I_in_wards)
+        return
+
+    infect_file = output_dir.open(f"wards_trajectory{name}_I.csv")
     if population.day == 0:
         # Print header
         ident: List[str] = ["day", "date"]
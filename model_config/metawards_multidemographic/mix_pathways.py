@@ -1,16 +1,10 @@
-from metawards.mixers import merge_using_matrix
+from uq4metawards.mixers import get_matrix_merger
 
 
-def mix_pathways(network, **kwargs):
-    params = network.params
-
-    # how much FOI to GP population is affected by others
+# how much FOI to GP population is affected by others
+def interaction_matrix(GP_A: float, GP_H: float, GP_C: float) -> list:
     GP_GP = 1.0
-    GP_A = params.user_params["GP_A"]
-    GP_H = params.user_params["GP_H"]
-    GP_C = params.user_params["GP_C"]
-
-    matrix = \
+    return \
         [
             [GP_GP, GP_A, GP_H, GP_C],
             [0.0, 0.0, 0.0, 0.0],
@@ -18,5 +12,14 @@ def mix_pathways(network, **kwargs):
             [0.0, 0.0, 0.0, 0.0]
         ]
 
-    network.demographics.interaction_matrix = matrix
-    return [merge_using_matrix]
+
+# The matrix is built once per design point, the merge skips the rows and terms that are zero
+def mix_pathways(network, **kwargs):
+    params = network.params
+    key = (params.user_params["GP_A"], params.user_params["GP_H"], params.user_params["GP_C"])
+    merger = get_matrix_merger(key, lambda: interaction_matrix(*key))
+
+    # Keep the matrix on the network for anything else that looks at it
+    if network.demographics.interaction_matrix is not merger.matrix:
+        network.demographics.interaction_matrix = merger.matrix
+    return [merger.merge]
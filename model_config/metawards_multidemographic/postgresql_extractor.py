@@ -1,16 +1,27 @@
 from metawards.extractors import extract_default
 from metawards import Networks, OutputFiles, Population, Workspace
 from metawards.utils import Console
-import psycopg2 as psg
+from uq4metawards.active import ActiveWards
+from uq4metawards.postgres import get_pool, CopyUpsertWriter
+from uq4metawards.stages import stage_matrix
+from uq4metawards.writebehind import WriteBehind
+from functools import partial
+from typing import List, Union
 from os import path
+import numpy as np
+import atexit
 
 #
 # Send all results to a PostgreSQL server
 # This will make a giant results table which is keyed by design ID and run ID in order to paste them together
+# Days are buffered and sent in bulk (COPY + one upsert), set .flush_days to control how many are held back
+# The day each ward was first infected goes to <table_name>_first_infection at the end of the run
 
 database_name = "myrun"
 table_name = "post_results_2"
 
+_connection_params = {"host": "localhost", "user": "uqwrite", "password": "uq4covid", "database": database_name}
+
 # Output list
 _out_channels = \
     {
@@ -20,7 +31,18 @@ _out_channels = \
         "hospital": [2, 3, 4, 5]
     }
 
-_zero_crossings = {}
+# Wards that have had an infection in this run, nothing is written for the others
+_active = ActiveWards()
+
+# Which run this is, as (design, repeat)
+_run_key: Union[tuple, None] = None
+
+# Sending happens on a background thread, shared by every run in this process
+_writer: Union[WriteBehind, None] = None
+_max_pending_days: int = 8
+
+# Days are sent in batches of _flush_days days
+_flush_days: int = 10
 
 
 def initialise(conn, network):
@@ -33,61 +55,122 @@ def initialise(conn, network):
               f"PRIMARY KEY (design, repeat, day, ward));"
     Console.print(f"POSTGRESQL Exec: \n{qstring}")
     c.execute(qstring)
+    c.execute(f"CREATE TABLE IF NOT EXISTS {table_name}_first_infection(design INT NOT NULL, repeat INT NOT NULL, "
+              f"ward INT NOT NULL, day INT NOT NULL, PRIMARY KEY (design, repeat, ward));")
     conn.commit()
 
 
+# Everything that talks to the server, this lives on the write-behind thread
+class PostgresSink:
+    def __init__(self, network: Networks):
+        # Make sure the table exists and set up the bulk writer, this is only done once per process
+        connection_pool = get_pool(_connection_params)
+        connection = connection_pool.getconn()
+        try:
+            initialise(connection, network)
+        finally:
+            connection_pool.putconn(connection)
+
+        # NOTE: The table was made with unquoted names, which PostgreSQL folds to lower case
+        value_columns = [f"{subnet.name}_{i}".lower() for subnet in network.subnets
+                         for i in _out_channels[subnet.name]]
+        self.writer = CopyUpsertWriter(connection_pool, table_name, ["design", "repeat", "day", "ward"],
+                                       value_columns)
+        self.first_writer = CopyUpsertWriter(connection_pool, f"{table_name}_first_infection",
+                                             ["design", "repeat", "ward"], ["day"])
+        self.flush_days: int = 10
+        self.pending: List[np.ndarray] = []
+
+    def start_run(self, flush_days: int):
+        self.flush()
+        self.flush_days = flush_days
+
+    # Buffer one day of (wards, columns) rows
+    def add_day(self, rows: np.ndarray):
+        self.pending.append(rows)
+        if len(self.pending) >= self.flush_days:
+            self.flush()
+
+    # Send everything that has been buffered
+    def flush(self):
+        if self.pending:
+            self.writer.write(np.concatenate(self.pending))
+        self.pending = []
+
+    # Send the (ward, day) first infections of a run
+    def add_first_infections(self, design_index: int, repeat_ident: int, first: np.ndarray):
+        if first.shape[0] != 0:
+            keys = np.empty((first.shape[0], 2), dtype=np.int64)
+            keys[:, 0] = design_index
+            keys[:, 1] = repeat_ident
+            self.first_writer.write(np.concatenate([keys, first], axis=1))
+
+    def close(self):
+        self.flush()
+
+
+# The background writer for this process, started on first use
+def get_writer(network: Networks) -> WriteBehind:
+    global _writer
+    if _writer is None:
+        _writer = WriteBehind(partial(PostgresSink, network), _max_pending_days)
+        atexit.register(_writer.close)
+    return _writer
+
+
 def output_db(population: Population, network: Networks,
               workspace: Workspace, output_dir: OutputFiles, **kwargs):
+    global _flush_days
+    global _run_key
 
     Console.print(f"Calling output_db for a {network.__class__} object")
-    postgres_connection = psg.connect(host="localhost", user="uqwrite", password="uq4covid", database=database_name)
+    writer = get_writer(network)
 
-    # Make sure init is only called once, it actually doesn't matter, but saves time
-    if not hasattr(network, "init_guard"):
-        initialise(postgres_connection, network)
-        setattr(network, "init_guard", False)
+    # Start of a new run
+    if not hasattr(network.params, "_uq4covid_setup"):
+        network.params._uq4covid_setup = True
+        _flush_days = max(1, int(network.params.user_params.get("flush_days", _flush_days)))
+        writer.submit(PostgresSink.start_run, _flush_days)
+        _active.reset()
 
-    cur = postgres_connection.cursor()
-    run_ident = path.basename(output_dir.get_path())
-    repeat_ident = int(run_ident[-3:])
-    design_index = int(network.params.user_params["design_index"])
+        run_ident = path.basename(output_dir.get_path())
+        _run_key = (int(network.params.user_params["design_index"]), int(run_ident[-3:]))
+    design_index, repeat_ident = _run_key
 
-    # get each demographics data
+    # get each demographics data, as (wards, channels) blocks in the same column order as the writer
+    blocks: List[np.ndarray] = []
     for i, subnet in enumerate(network.subnets):
-        ward_inf_tot = workspace.subspaces[i].ward_inf_tot
-        N_INF_CLASSES = workspace.subspaces[i].n_inf_classes
-        col2_names = ["design", "repeat", "day", "ward"] + \
-                     [f"{subnet.name}_{i}" for i in _out_channels[subnet.name]]
-        for k in range(1, workspace.subspaces[i].nnodes + 1):
-            if k not in _zero_crossings:
-                _zero_crossings[k] = False
-            vals = [design_index, repeat_ident, population.day, k]
-            for j in range(0, N_INF_CLASSES):
-
-                # Try to fudge a marker for first infections
-                if ward_inf_tot[0][k] != 0 and _zero_crossings[k] is False:
-                    _zero_crossings[k] = True
-                    Console.print(f"Got first infection in ward {k}")
-
-                # TODO: What is this?? Why are some classes deltas?
-                if j == 1 or j == 3:
-                    vals.append(ward_inf_tot[j - 1][k] + ward_inf_tot[j][k])
-                else:
-                    vals.append(ward_inf_tot[j][k])
-            col2_str = ','.join(col2_names)
-            update_cols = col2_names[4:]
-            keeps = [vals[x + 4] for x in range(N_INF_CLASSES) if x in _out_channels[subnet.name]]
-            keeps_str = ",".join([str(v) for v in [design_index, repeat_ident, population.day, k] + keeps])
-            update_str = ','.join([f"{c} = {v}" for c, v in zip(update_cols, keeps)])
-            qstring = f"INSERT INTO {table_name} ({col2_str}) VALUES ({keeps_str}) " \
-                      f"ON CONFLICT (design, repeat, day, ward) DO UPDATE SET {update_str};"
-            if _zero_crossings[k] is True:
-                cur.execute(qstring)
-    postgres_connection.commit()
-    postgres_connection.close()
-
-
-def extract_db(**kwargs):
+        stages = stage_matrix(workspace.subspaces[i].ward_inf_tot, workspace.subspaces[i].n_inf_classes)
+        for k in _active.update(population.day, stages[0]):
+            Console.print(f"Got first infection in ward {k}")
+        blocks.append(stages[_out_channels[subnet.name]].T)
+
+    # One row per infected ward, this is a new array so the writer can have it
+    wards = _active.wards
+    keys = np.empty((wards.size, 4), dtype=np.int64)
+    keys[:, 0] = design_index
+    keys[:, 1] = repeat_ident
+    keys[:, 2] = population.day
+    keys[:, 3] = wards
+    writer.submit(PostgresSink.add_day, np.concatenate([keys] + [x[wards] for x in blocks], axis=1))
+
+
+# End of the run, make sure nothing is left behind
+def finalise_db(**kwargs):
+    if _writer is not None:
+        _writer.submit(PostgresSink.flush)
+        if _run_key is not None:
+            _writer.submit(PostgresSink.add_first_infections, *_run_key, _active.first_infections())
+        _writer.wait()
+
+
+# Taking "stage" means every stage comes here, the ones we don't use are passed on to the default extractor
+def extract_db(stage: str, **kwargs):
     funcs = []
-    funcs.append(output_db)
+    if stage == "analyse":
+        funcs.append(output_db)
+    elif stage == "finalise":
+        funcs = extract_default(stage=stage, **kwargs) + [finalise_db]
+    else:
+        funcs = extract_default(stage=stage, **kwargs)
     return funcs
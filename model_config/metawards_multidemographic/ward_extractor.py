@@ -1,6 +1,42 @@
 from metawards.extractors import extract_default
 from metawards import Networks, OutputFiles, Population, Workspace
 from metawards.utils import Console
+from uq4metawards.active import ActiveWards
+from uq4metawards.stages import stage_matrix
+from uq4metawards.writebehind import WriteBehind
+from sqlite3 import Connection, connect
+from typing import Dict, List, Sequence, Union
+from os import path
+import numpy as np
+import atexit
+
+#
+# Ward level output for multi-demographic models, in up to three layouts (each in its own database in the run folder)
+#   totals:  one <demographic>_totals(day, ward, stage_0, ...) table per demographic, in stages.db
+#   results: one results(day, ward, <demographic>_<stage>, ...) table across all demographics, in stages2.db
+#   compact: as results but only holding the stages listed in _out_channels, in stages3.db
+# Use make_extract_db to pick the layouts, see ward_extractor2.py and ward_extractor3.py
+# Every database also gets a first_infection(ward, day) table with the day each ward was first infected
+#
+
+# Output list
+_out_channels = \
+    {
+        "asymp": [2, 3, 4],
+        "genpop": [0, 1, 2, 3, 4, 5],
+        "hospital": [2, 3, 4, 5],
+        "critical": [2, 3, 4, 5]
+    }
+
+_layout_files = {"totals": "stages.db", "results": "stages2.db", "compact": "stages3.db"}
+
+# Writes happen on a background thread, shared by every run in this process
+_writer: Union[WriteBehind, None] = None
+_max_pending_days: int = 8
+
+# Wards that have had an infection in this run and when that happened
+_active = ActiveWards()
+
 
 def create_tables(network: Networks):
     # return a function that creates the tables
@@ -22,43 +58,189 @@ def create_tables(network: Networks):
     return initialise
 
 
-def output_db(population: Population, network: Networks,
-              workspace: Workspace, output_dir: OutputFiles, **kwargs):
-
-    Console.print(f"Calling output_db for a {network.__class__} object")
-
-    # open a database to hold the data - call the 'create_tables'
-    # function on this database when it is first opened
-    conn = output_dir.open_db("stages.db",
-                              initialise=create_tables(network))
-
-    c = conn.cursor()
-
-    # get each demographics data
-    for i, subnet in enumerate(network.subnets):
-        name = subnet.name
-
-        ward_inf_tot = workspace.subspaces[i].ward_inf_tot
+def create_tables_2(network: Networks):
+    # return a function that creates the tables
+    # for the specified number of disease classes
+    # Primary key needs to be composite here
 
-        N_INF_CLASSES = workspace.subspaces[i].n_inf_classes
+    def initialise(conn):
+        c = conn.cursor()
+        table_name: str = "results"
+        values: List[str] = []
+        for i, subnet in enumerate(network.subnets):
+            num_classes = subnet.params.disease_params.N_INF_CLASSES()
+            values += [f"{subnet.name}_{i} int" for i in range(0, num_classes)]
+        c.execute(f"create table {table_name}(day int not null, ward int not null, {','.join(values)}, "
+                  f"primary key (day, ward))")
+        conn.commit()
 
-        for k in range(1, workspace.subspaces[i].nnodes+1):
-            vals = [population.day, k]
-            for j in range(0, N_INF_CLASSES):
-                if j == 1 or j == 3:
-                    vals.append(ward_inf_tot[j - 1][k] + ward_inf_tot[j][k])
-                else:
-                    vals.append(ward_inf_tot[j][k])
+    return initialise
 
-            vals_str = ",".join([str(v) for v in vals])
 
-            c.execute(f"insert into {name}_totals VALUES ({vals_str})")
+def create_tables_3(network: Networks):
+    # return a function that creates the tables
+    # for the specified number of disease classes
+    # Primary key needs to be composite here
 
-    conn.commit()
+    def initialise(conn):
+        c = conn.cursor()
+        table_name: str = "compact"
+        values: List[str] = []
+        for i, subnet in enumerate(network.subnets):
+            values += [f"{subnet.name}_{i} int" for i in _out_channels[subnet.name]]
+        c.execute(f"create table {table_name}(day int not null, ward int not null, {','.join(values)}, "
+                  f"primary key (day, ward))")
+        conn.commit()
 
+    return initialise
 
-def extract_db(**kwargs):
-    funcs = []
-    funcs.append(output_db)
-    return funcs
 
+_layout_tables = {"totals": create_tables, "results": create_tables_2, "compact": create_tables_3}
+
+
+# Build (wards, day + ward + values) rows from (values, wards + 1) blocks, only for the given wards
+def make_rows(day: int, wards: np.ndarray, blocks: List[np.ndarray]) -> List[list]:
+    rows = np.empty((wards.size, 2 + sum(x.shape[0] for x in blocks)), dtype=np.int64)
+    rows[:, 0] = day
+    rows[:, 1] = wards
+    column = 2
+    for block in blocks:
+        rows[:, column:column + block.shape[0]] = block[:, wards].T
+        column += block.shape[0]
+
+    # NOTE: tolist() hands sqlite plain ints, it can't bind numpy integers
+    return rows.tolist()
+
+
+# An upsert on (day, ward) for the tables that span all demographics
+def upsert_query(table_name: str, columns: List[str]) -> str:
+    update_str = ','.join([f"{c} = excluded.{c}" for c in columns[2:]])
+    return f"insert into {table_name} ({','.join(columns)}) values ({','.join(['?'] * len(columns))}) " \
+           f"on conflict(day, ward) do update set {update_str}"
+
+
+# Writes the databases of the current run, this lives on the write-behind thread
+class StagesSink:
+    def __init__(self):
+        self.connections: Dict[str, Connection] = {}
+
+    def start_run(self, files: Dict[str, str]):
+        self.close()
+        self.connections = {layout: connect(file_name) for layout, file_name in files.items()}
+
+    # Write one day, stages holds a (stages, wards + 1) snapshot for each demographic and wards lists the wards to
+    # write, every layout gets one executemany per table
+    def add_day(self, day: int, names: List[str], stages: List[np.ndarray], wards: np.ndarray):
+        if "totals" in self.connections and wards.size > 0:
+            for name, values in zip(names, stages):
+                self.connections["totals"].executemany(f"insert into {name}_totals "
+                                                       f"VALUES ({','.join(['?'] * (values.shape[0] + 2))})",
+                                                       make_rows(day, wards, [values]))
+        if "results" in self.connections:
+            columns = ["day", "ward"] + [f"{name}_{i}" for name, x in zip(names, stages) for i in range(x.shape[0])]
+            self.connections["results"].executemany(upsert_query("results", columns),
+                                                    make_rows(day, wards, stages))
+        if "compact" in self.connections:
+            columns = ["day", "ward"] + [f"{name}_{i}" for name in names for i in _out_channels[name]]
+            self.connections["compact"].executemany(
+                upsert_query("compact", columns),
+                make_rows(day, wards, [x[_out_channels[name]] for name, x in zip(names, stages)]))
+        for connection in self.connections.values():
+            connection.commit()
+
+    # Write the (ward, day) first infections of the run to every database
+    def add_first_infections(self, first: np.ndarray):
+        for connection in self.connections.values():
+            connection.execute("create table if not exists first_infection(ward int not null primary key, "
+                               "day int not null)")
+            connection.executemany("insert or replace into first_infection(ward, day) values (?, ?)", first.tolist())
+            connection.commit()
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.commit()
+            connection.close()
+        self.connections = {}
+
+
+# The background writer for this process, started on first use
+def get_writer() -> WriteBehind:
+    global _writer
+    if _writer is None:
+        _writer = WriteBehind(StagesSink, _max_pending_days)
+        atexit.register(_writer.close)
+    return _writer
+
+
+# Make the extractor output functions for a set of layouts
+# skip_uninfected leaves out wards that have not had an infection (in stage 0) yet this run
+def make_output_db(layouts: Sequence[str], skip_uninfected: bool = False):
+    unknown = [x for x in layouts if x not in _layout_files]
+    if unknown or not layouts:
+        raise ValueError(f"Unknown ward output layouts {unknown}, pick from {list(_layout_files.keys())}")
+
+    def output_db(population: Population, network: Networks,
+                  workspace: Workspace, output_dir: OutputFiles, **kwargs):
+        Console.print(f"Calling output_db for a {network.__class__} object")
+
+        # open a database to hold the data - call the 'create_tables'
+        # function on this database when it is first opened
+        for layout in layouts:
+            output_dir.open_db(_layout_files[layout], initialise=_layout_tables[layout](network))
+
+        # The rows themselves are written by the background writer on its own connections
+        writer = get_writer()
+        if not hasattr(network.params, "_uq4covid_setup"):
+            network.params._uq4covid_setup = True
+            writer.submit(StagesSink.start_run, {x: path.join(output_dir.get_path(), _layout_files[x])
+                                                 for x in layouts})
+            _active.reset()
+
+        # get each demographics data, stage_matrix makes a copy so the writer can have it
+        names = [subnet.name for subnet in network.subnets]
+        stages = [stage_matrix(workspace.subspaces[i].ward_inf_tot, workspace.subspaces[i].n_inf_classes)
+                  for i in range(len(names))]
+
+        # A ward is infected once stage 0 (new infections) is non-zero in any demographic
+        for values in stages:
+            first = _active.update(population.day, values[0])
+            if skip_uninfected:
+                for k in first:
+                    Console.print(f"Got first infection in ward {k}")
+
+        wards = _active.wards if skip_uninfected else np.arange(1, stages[0].shape[1])
+
+        writer.submit(StagesSink.add_day, population.day, names, stages, wards)
+
+    return output_db
+
+
+# Everything for the run has to be in the database before MetaWards closes (and maybe compresses) it
+def finalise_db(**kwargs):
+    if _writer is not None:
+        _writer.submit(StagesSink.add_first_infections, _active.first_infections())
+        _writer.submit(StagesSink.close)
+        _writer.wait()
+
+
+# Make an extractor that writes a set of layouts
+# Taking "stage" means every stage comes here, the ones we don't use are passed on to the default extractor
+def make_extract_db(layouts: Sequence[str], skip_uninfected: bool = False):
+    output_db = make_output_db(layouts, skip_uninfected)
+
+    def extract_db(stage: str, **kwargs):
+        funcs = []
+        if stage == "analyse":
+            funcs.append(output_db)
+        elif stage == "finalise":
+            funcs = extract_default(stage=stage, **kwargs) + [finalise_db]
+        else:
+            funcs = extract_default(stage=stage, **kwargs)
+        return funcs
+
+    return extract_db
+
+
+# The original layout: a totals table per demographic
+output_db = make_output_db(["totals"])
+extract_db = make_extract_db(["totals"])
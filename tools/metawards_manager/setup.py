@@ -27,7 +27,10 @@ setuptools.setup \
                     "uq4metawards-pre = uq4metawards.workflow.pre:main",
                     "uq4metawards-uq3a = uq4metawards.workflow.uq3a:main",
                     "uq4metawards-uq3b = uq4metawards.workflow.uq3b:main",
-                    "uq4metawards-uq4 = uq4metawards.workflow.uq4:main"
+                    "uq4metawards-uq4 = uq4metawards.workflow.uq4:main",
+                    "uq4metawards-pack = uq4metawards.workflow.pack:main",
+                    "uq4metawards-merge = uq4metawards.workflow.merge:main",
+                    "uq4metawards-extend = uq4metawards.workflow.extend:main"
                 ]
             }
         )
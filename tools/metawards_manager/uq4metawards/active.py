@@ -0,0 +1,49 @@
+#
+# Active wards: which wards have seen an infection so far in a run, and the day that it first happened
+#
+# Early in an epidemic only a handful of wards have any infections, extractors can use the mask to only write those
+#
+
+import numpy as np
+from typing import Union
+
+
+# Tracks the wards of one run, call reset() at the start of every run
+# NOTE: Arrays follow the MetaWards ward numbering, so element 0 is the unused ward and is never active
+class ActiveWards:
+    def __init__(self):
+        self.mask: Union[np.ndarray, None] = None
+        self.first_day: Union[np.ndarray, None] = None
+
+    def reset(self):
+        self.mask = None
+        self.first_day = None
+
+    # Mark every ward with a non-zero value as active, e.g. update(day, stages[0]) with the newly infected
+    # Can be called several times a day (once per demographic), returns the wards that became active in this call
+    def update(self, day: int, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values)
+        if self.mask is None:
+            self.mask = np.zeros(values.size, dtype=bool)
+            self.first_day = np.full(values.size, -1, dtype=np.int64)
+        elif values.size != self.mask.size:
+            raise ValueError(f"Got {values.size} wards, expected {self.mask.size}")
+        new = (values != 0) & ~self.mask
+        new[0] = False
+        self.mask |= new
+        self.first_day[new] = day
+        return np.flatnonzero(new)
+
+    # The active wards, in order
+    @property
+    def wards(self) -> np.ndarray:
+        if self.mask is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.mask)
+
+    # (ward, first day) for every ward that has been infected, in ward order
+    def first_infections(self) -> np.ndarray:
+        wards = self.wards
+        if wards.size == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        return np.column_stack([wards, self.first_day[wards]])
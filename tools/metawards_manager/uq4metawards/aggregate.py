@@ -0,0 +1,35 @@
+#
+# Aggregation of ward level output up to larger geographies (local authorities, regions, countries...)
+#
+
+import numpy as np
+import pandas as pd
+from typing import List
+
+
+# A ward to area operator that is built once from the ward lookup table and then applied to whole arrays
+# The ward columns are re-ordered so each area is a contiguous block, then every block is summed in one reduceat call
+# NOTE: Ward values are expected in trajectory order, i.e. ward[FID] is held in column FID - 1
+class WardAggregator:
+    def __init__(self, ward_data: pd.DataFrame, area_column: str = "LAD11NM", ward_column: str = "FID"):
+        # Areas are sorted by name (the same order as a pandas groupby), wards without an area are left out
+        codes, names = pd.factorize(ward_data[area_column], sort=True)
+        if len(names) == 0:
+            raise ValueError(f"No areas found in column {area_column}")
+        wards = ward_data[ward_column].values.astype(int) - 1
+        keep = codes >= 0
+        order = np.argsort(codes[keep], kind="stable")
+        sorted_codes = codes[keep][order]
+        self.area_column: str = area_column
+        self.names: List[str] = [str(x) for x in names]
+        self.ward_columns: np.ndarray = wards[keep][order]
+        self.starts: np.ndarray = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+
+    # Number of areas the wards are summed into
+    def __len__(self) -> int:
+        return len(self.names)
+
+    # Sum the last axis of an array of ward values, e.g. (days, wards) -> (days, areas)
+    def __call__(self, ward_values: np.ndarray) -> np.ndarray:
+        ward_values = np.asarray(ward_values)
+        return np.add.reduceat(ward_values[..., self.ward_columns], self.starts, axis=-1)
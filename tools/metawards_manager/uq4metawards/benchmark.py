@@ -0,0 +1,324 @@
+#
+# Benchmarks for the MetaWards plugins in uq4metawards, run with python -m uq4metawards.benchmark <name>
+#
+# These use synthetic ward data, each one checks that the fast version gives exactly the same answer as MetaWards'
+# own function (go_stage or merge_using_matrix) before timing them. Only the parts of the network that those functions
+# read are filled in, around a real Networks
+# MetaWards draws from its own generator, so go_stage is checked with every fraction set to 1.0 (deterministic moves)
+# If MetaWards isn't installed the checks fall back to numpy transcriptions of those functions, which is all they
+# then show
+#
+
+import argparse
+import sys
+import time
+import numpy as np
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+from uq4metawards.mixers import MatrixMerger
+from uq4metawards.movers import CompiledMove, apply_plan
+
+# The multi-demographic pathways (see model_config/metawards_multidemographic/move_pathways.py) with fixed fractions
+_example_plan: List[CompiledMove] = \
+    [
+        ("critical", "critical", 2, 3, 1.0),
+        ("critical", "critical", 3, 4, 0.25),
+        ("critical", "critical", 3, 5, 0.2),
+        ("hospital", "hospital", 2, 3, 1.0),
+        ("hospital", "critical", 3, 2, 0.05),
+        ("hospital", "hospital", 3, 4, 0.3),
+        ("hospital", "hospital", 3, 5, 0.04),
+        ("genpop", "genpop", 2, 3, 1.0),
+        ("genpop", "hospital", 3, 2, 0.02),
+        ("genpop", "genpop", 3, 4, 0.4),
+        ("genpop", "genpop", 3, 5, 0.01),
+        ("asymp", "asymp", 2, 3, 1.0),
+        ("asymp", "asymp", 3, 4, 0.5),
+        ("genpop", "genpop", 0, 1, 1.0),
+        ("genpop", "asymp", 1, 2, 0.25),
+        ("genpop", "genpop", 1, 2, 0.6)
+    ]
+_example_demographics: List[str] = ["genpop", "asymp", "hospital", "critical"]
+_example_stages: int = 6
+
+
+# Time a function over a number of repeats, returns the best time in seconds
+def best_time(func: Callable, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Synthetic infection arrays for the movers, occupancy is the chance that a ward / link has anyone in a stage
+def make_mover_state(n_links: int, n_nodes: int, occupancy: float, seed: int) -> tuple:
+    rng = np.random.default_rng(seed)
+
+    def stage(n: int) -> np.ndarray:
+        return (rng.integers(1, 50, n) * (rng.random(n) < occupancy)).astype(np.int32)
+
+    work = {(x, s): stage(n_links) for x in _example_demographics for s in range(_example_stages)}
+    play = {(x, s): stage(n_nodes) for x in _example_demographics for s in range(_example_stages)}
+    work_weight = {x: sum(work[(x, s)] for s in range(_example_stages)).astype(np.float64) + 1000.0
+                   for x in _example_demographics}
+    play_weight = {x: sum(play[(x, s)] for s in range(_example_stages)).astype(np.float64) + 1000.0
+                   for x in _example_demographics}
+    return work, play, work_weight, play_weight
+
+
+def copy_mover_state(state: tuple) -> tuple:
+    return tuple({k: v.copy() for k, v in x.items()} for x in state)
+
+
+# The go_stage chain written out in numpy: every move sweeps all of the wards, then the populations of the
+# demographics it touched are recalculated (as go_stage does)
+# NOTE: This is a transcription of metawards.movers.go_stage, not a call to it
+def go_stage_chain(plan: List[CompiledMove], work: Dict[Tuple[str, int], np.ndarray],
+                   play: Dict[Tuple[str, int], np.ndarray], work_weight: Dict[str, np.ndarray],
+                   play_weight: Dict[str, np.ndarray], rng: np.random.Generator) -> Dict[str, float]:
+    populations: Dict[str, float] = {}
+    for go_from, go_to, from_stage, to_stage, fraction in plan:
+        for infections, weights in ((work, work_weight), (play, play_weight)):
+            source = infections[(go_from, from_stage)]
+            if fraction == 1.0:
+                moved = np.where(source > 0, source, 0)
+            else:
+                moved = rng.binomial(np.maximum(source, 0), fraction)
+            source -= moved.astype(source.dtype)
+            infections[(go_to, to_stage)] += moved.astype(source.dtype)
+            weights[go_from] -= moved
+            weights[go_to] += moved
+        for x in {go_from, go_to}:
+            populations[x] = float(work_weight[x].sum() + play_weight[x].sum())
+    return populations
+
+
+# The mover state as MetaWards objects, for its go_stage: a Networks around stand-in subnets and infections with the
+# unused element 0 put back. Returns (network, infections, state) where state has views of the same arrays without
+# element 0, in the form make_mover_state gives
+def make_metawards_mover_state(state: tuple) -> tuple:
+    from metawards import Networks
+    work, play, work_weight, play_weight = state
+    names = list(work_weight.keys())
+    n_stages = 1 + max(s for _, s in work.keys())
+
+    def padded(x: np.ndarray, dtype) -> np.ndarray:
+        return np.concatenate([np.zeros(1, dtype=dtype), x.astype(dtype)])
+
+    def stand_in_subnet(name: str) -> SimpleNamespace:
+        return SimpleNamespace(name=name, links=SimpleNamespace(weight=padded(work_weight[name], np.float64)),
+                               nodes=SimpleNamespace(save_play_suscept=padded(play_weight[name], np.float64)),
+                               params=SimpleNamespace(disease_params=SimpleNamespace(get_index=int)),
+                               recalculate_denominators=lambda profiler=None: None)
+
+    network = Networks()
+    network.subnets = [stand_in_subnet(x) for x in names]
+    network.demographics = SimpleNamespace(get_index=names.index)
+    n_links, n_nodes = work[(names[0], 0)].size, play[(names[0], 0)].size
+    infections = SimpleNamespace(subinfs=[SimpleNamespace(
+        nlinks=n_links, nnodes=n_nodes,
+        work=[padded(work.get((x, s), np.zeros(n_links)), np.int32) for s in range(n_stages)],
+        play=[padded(play.get((x, s), np.zeros(n_nodes)), np.int32) for s in range(n_stages)]) for x in names])
+
+    views = ({k: infections.subinfs[names.index(k[0])].work[k[1]][1:] for k in work},
+             {k: infections.subinfs[names.index(k[0])].play[k[1]][1:] for k in play},
+             {x: network.subnets[i].links.weight[1:] for i, x in enumerate(names)},
+             {x: network.subnets[i].nodes.save_play_suscept[1:] for i, x in enumerate(names)})
+    return network, infections, views
+
+
+# MetaWards' go_stage for every move of a plan, in order
+def metawards_go_stage_chain(plan: List[CompiledMove], network, infections, rngs):
+    from metawards.movers import go_stage
+    from metawards.utils import NullProfiler
+    profiler = NullProfiler()
+    for go_from, go_to, from_stage, to_stage, fraction in plan:
+        go_stage(go_from=go_from, go_to=go_to, from_stage=from_stage, to_stage=to_stage, fraction=fraction,
+                 network=network, infections=infections, rngs=rngs, profiler=profiler, nthreads=1)
+
+
+def _have_metawards() -> bool:
+    try:
+        import metawards  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+# The fused mover, populations are only recalculated once at the end
+def fused_moves(plan: List[CompiledMove], work: Dict[Tuple[str, int], np.ndarray],
+                play: Dict[Tuple[str, int], np.ndarray], work_weight: Dict[str, np.ndarray],
+                play_weight: Dict[str, np.ndarray], rng: np.random.Generator) -> Dict[str, float]:
+    return {x: float(work_weight[x].sum() + play_weight[x].sum())
+            for x in apply_plan(plan, work, play, work_weight, play_weight, rng)}
+
+
+def benchmark_movers(argv) -> bool:
+    print(f"Movers: {len(_example_plan)} moves, {argv.links} links, {argv.nodes} wards, occupancy {argv.occupancy}")
+    state = make_mover_state(argv.links, argv.nodes, argv.occupancy, argv.seed)
+
+    # Check a few days in a row against each other
+    have_metawards = _have_metawards()
+    if have_metawards:
+        deterministic = [(a, b, c, d, 1.0) for a, b, c, d, _ in _example_plan]
+        network, infections, metawards_state = make_metawards_mover_state(state)
+        fused_state = copy_mover_state(state)
+        for day in range(argv.days):
+            metawards_go_stage_chain(deterministic, network, infections, np.zeros(1, dtype=np.uintp))
+            fused_moves(deterministic, *fused_state, np.random.default_rng(argv.seed))
+        identical = all(np.array_equal(a[k], b[k]) for a, b in zip(metawards_state, fused_state) for k in a)
+        print(f"Same result as MetaWards' go_stage (every fraction 1.0) after {argv.days} days: {identical}")
+    else:
+        chain_state, fused_state = copy_mover_state(state), copy_mover_state(state)
+        chain_rng, fused_rng = np.random.default_rng(argv.seed + 1), np.random.default_rng(argv.seed + 1)
+        identical = True
+        for day in range(argv.days):
+            chain_populations = go_stage_chain(_example_plan, *chain_state, chain_rng)
+            fused_populations = fused_moves(_example_plan, *fused_state, fused_rng)
+            identical = identical and chain_populations == fused_populations
+        identical = identical and all(np.array_equal(a[k], b[k]) for a, b in zip(chain_state, fused_state)
+                                      for k in a)
+        print("MetaWards isn't installed, checking against the numpy go_stage transcription instead")
+        print(f"Same result as the numpy go_stage transcription after {argv.days} days: {identical}")
+
+    def run_chain():
+        go_stage_chain(_example_plan, *copy_mover_state(state), np.random.default_rng(argv.seed))
+
+    def run_fused():
+        fused_moves(_example_plan, *copy_mover_state(state), np.random.default_rng(argv.seed))
+
+    def run_copy():
+        copy_mover_state(state)
+
+    copy_time = best_time(run_copy, argv.repeats)
+    chain_time = best_time(run_chain, argv.repeats) - copy_time
+    fused_time = best_time(run_fused, argv.repeats) - copy_time
+    if have_metawards:
+        from metawards.utils import create_thread_generators, seed_ran_binomial
+        rngs = create_thread_generators(seed_ran_binomial(argv.seed), 1)
+
+        def run_metawards():
+            metawards_go_stage_chain(_example_plan, *make_metawards_mover_state(state)[:2], rngs)
+
+        def run_metawards_copy():
+            make_metawards_mover_state(state)
+
+        # NOTE: The stand-in subnets don't recalculate denominators, which go_stage does after every move and the
+        # fused mover once per demographic, so this is only the cost of the moves themselves
+        metawards_time = best_time(run_metawards, argv.repeats) - best_time(run_metawards_copy, argv.repeats)
+        print(f"go_stage chain:         {metawards_time * 1000.0:.2f} ms/day (without recalculating denominators)")
+    print(f"go_stage chain (numpy): {chain_time * 1000.0:.2f} ms/day")
+    print(f"fused mover:            {fused_time * 1000.0:.2f} ms/day ({chain_time / max(fused_time, 1e-12):.1f}x "
+          f"the numpy chain" + (f", {metawards_time / max(fused_time, 1e-12):.1f}x go_stage)" if have_metawards
+                                 else ")"))
+    return identical
+
+
+# merge_using_matrix written out in numpy: every row gets every demographic added in, then all are copied back
+# NOTE: This is a transcription of metawards.mixers.merge_using_matrix, not a call to it
+def merge_using_matrix(matrix, fois: List[np.ndarray]):
+    merged = [np.zeros(fois[0].shape[0]) for _ in fois]
+    for i in range(len(fois)):
+        for j in range(len(fois)):
+            merged[i] += matrix[i][j] * fois[j]
+    for j in range(len(fois)):
+        fois[j][:] = merged[j]
+
+
+# The day and night FOIs as a MetaWards Networks for merge_using_matrix (and MatrixMerger.merge), around stand-in
+# subnets with the unused element 0 put back
+def make_metawards_mixer_network(matrix, day_fois: List[np.ndarray], night_fois: List[np.ndarray]):
+    from metawards import Networks
+    n_nodes = day_fois[0].size
+
+    def padded(x: np.ndarray) -> np.ndarray:
+        return np.concatenate([np.zeros(1), x])
+
+    network = Networks()
+    network.subnets = [SimpleNamespace(nodes=SimpleNamespace(day_foi=padded(day), night_foi=padded(night)))
+                       for day, night in zip(day_fois, night_fois)]
+    network.overall = SimpleNamespace(nnodes=n_nodes, nodes=SimpleNamespace(day_foi=np.zeros(n_nodes + 1),
+                                                                            night_foi=np.zeros(n_nodes + 1)))
+    network.demographics = SimpleNamespace(interaction_matrix=matrix)
+    return network
+
+
+def benchmark_mixers(argv) -> bool:
+    # The multi-demographic matrix (see model_config/metawards_multidemographic/mix_pathways.py), only the first row
+    # is non-zero
+    matrix = [[1.0, 0.8, 0.1, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]]
+    merger = MatrixMerger(matrix)
+    print(f"Mixers: {len(matrix)} demographics, {argv.nodes} wards")
+    rng = np.random.default_rng(argv.seed)
+    fois = [rng.random(argv.nodes) * (rng.random(argv.nodes) < argv.occupancy) for _ in matrix]
+
+    have_metawards = _have_metawards()
+    if have_metawards:
+        from metawards.mixers import merge_using_matrix as metawards_merge_using_matrix
+        from metawards.utils import NullProfiler
+        night_fois = [rng.random(argv.nodes) * (rng.random(argv.nodes) < argv.occupancy) for _ in matrix]
+        plain = make_metawards_mixer_network(matrix, fois, night_fois)
+        fast = make_metawards_mixer_network(matrix, fois, night_fois)
+        metawards_merge_using_matrix(network=plain, nthreads=1, profiler=NullProfiler())
+        merger.merge(fast)
+        identical = all(np.array_equal(a.nodes.day_foi, b.nodes.day_foi) and
+                        np.array_equal(a.nodes.night_foi, b.nodes.night_foi)
+                        for a, b in zip(plain.subnets, fast.subnets))
+        print(f"Same result as MetaWards' merge_using_matrix: {identical}")
+    else:
+        plain, fast = [x.copy() for x in fois], [x.copy() for x in fois]
+        merge_using_matrix(matrix, plain)
+        merger.merge_arrays(fast)
+        identical = all(np.array_equal(a, b) for a, b in zip(plain, fast))
+        print("MetaWards isn't installed, checking against the numpy merge_using_matrix transcription instead")
+        print(f"Same result as the numpy merge_using_matrix transcription: {identical}")
+
+    # Both merge day and night FOIs each time
+    n_calls = 100
+    plain_time = best_time(lambda: [merge_using_matrix(matrix, fois) for _ in range(2 * n_calls)], argv.repeats)
+    fast_time = best_time(lambda: [merger.merge_arrays(fois) for _ in range(2 * n_calls)], argv.repeats)
+    if have_metawards:
+        network = make_metawards_mixer_network(matrix, fois, fois)
+        metawards_time = best_time(lambda: [metawards_merge_using_matrix(network=network, nthreads=1,
+                                                                         profiler=NullProfiler())
+                                            for _ in range(n_calls)], argv.repeats)
+        print(f"merge_using_matrix:         {metawards_time * 1000.0 / n_calls:.3f} ms/day")
+    print(f"merge_using_matrix (numpy): {plain_time * 1000.0 / n_calls:.3f} ms/day")
+    print(f"matrix merger:              {fast_time * 1000.0 / n_calls:.3f} ms/day "
+          f"({plain_time / max(fast_time, 1e-12):.1f}x the numpy version" +
+          (f", {metawards_time / max(fast_time, 1e-12):.1f}x merge_using_matrix)" if have_metawards else ")"))
+    return identical
+
+
+_benchmarks = {"movers": benchmark_movers, "mixers": benchmark_mixers}
+
+
+# NOTE: If you use argv as a parameter to main, you will have problems with the package setup entry points
+def main():
+    argv = main_parser()
+    if not _benchmarks[argv.name](argv):
+        print("Results differ!")
+        sys.exit(1)
+    sys.exit(0)
+
+
+#
+# This arg parser is wrapped in a function for testing purposes
+#
+def main_parser(main_args=None):
+    parser = argparse.ArgumentParser("uq4metawards benchmarks")
+    parser.add_argument('name', choices=list(_benchmarks.keys()), help="Benchmark to run")
+    parser.add_argument('--links', type=int, default=1000000, help="Number of work links")
+    parser.add_argument('--nodes', type=int, default=8588, help="Number of wards")
+    parser.add_argument('--occupancy', type=float, default=0.05,
+                        help="Chance that a ward / link has anyone in a disease stage")
+    parser.add_argument('--days', type=int, default=5, help="Days to run when checking the results")
+    parser.add_argument('--repeats', type=int, default=5, help="Timing repeats, the best is reported")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    return parser.parse_args(main_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#
+# Output channels for the ward extractors: named accessors onto the MetaWards workspace
+#
+# Channels are given as a dictionary of name -> source, where a source is either a workspace attribute holding one
+# value per ward (e.g. "I_in_wards") or a (demographic, stage) pair that picks a stage of a demographic's ward totals
+# The accessors are built once per run, so the daily extractor loop does no lookups, parsing or eval()
+#
+
+import numpy as np
+from typing import Callable, Dict, List, Tuple, Union
+
+ChannelSource = Union[str, Tuple[str, int]]
+ChannelAccessor = Callable[[object], np.ndarray]
+
+
+# Index a compartment: the ward totals of one disease stage of one demographic, as a numpy view
+def get_comp(network, workspace, demographic: str, stage: int) -> np.ndarray:
+    demo_index = network.demographics.get_index(demographic)
+    return np.asarray(workspace.subspaces[demo_index].ward_inf_tot[stage])
+
+
+# Build the accessor for one channel source, anything that can be looked up ahead of time is done here
+def make_accessor(source: ChannelSource, network) -> ChannelAccessor:
+    if isinstance(source, str):
+        def workspace_array(workspace) -> np.ndarray:
+            return np.asarray(getattr(workspace, source))
+        return workspace_array
+
+    demographic, stage = source
+    demo_index = network.demographics.get_index(demographic)
+
+    def demographic_stage(workspace) -> np.ndarray:
+        return np.asarray(workspace.subspaces[demo_index].ward_inf_tot[stage])
+    return demographic_stage
+
+
+# Readable description of a channel source for logging
+def describe_source(source: ChannelSource) -> str:
+    if isinstance(source, str):
+        return f"workspace.{source}"
+    return f"{source[0]} stage {source[1]}"
+
+
+# The channels of one run, in the order they were given (this order is the output channel id in the databases)
+class ChannelSet:
+    def __init__(self, channels: Dict[str, ChannelSource], network):
+        if not channels:
+            raise ValueError("No output channels given")
+        self.names: List[str] = list(channels.keys())
+        self.sources: List[ChannelSource] = list(channels.values())
+        self._accessors: List[ChannelAccessor] = [make_accessor(x, network) for x in self.sources]
+
+    def __len__(self) -> int:
+        return len(self._accessors)
+
+    # Ward values of a channel for the current day, element 0 is unused as in MetaWards
+    def read(self, channel: int, workspace) -> np.ndarray:
+        return self._accessors[channel](workspace)
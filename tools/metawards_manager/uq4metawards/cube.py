@@ -0,0 +1,117 @@
+#
+# Memory-mapped ensemble cube: ward output for every run held on disk as one (runs, days, wards) array
+#
+# The raw array lives in <cube file> and its shape, type and run index in <cube file>.json
+# Slicing the cube with plain slices/integers gives views onto the file, nothing is read until it is used
+#
+
+import json as js
+import numpy as np
+from typing import List, Tuple, Iterable, Optional
+from .store import EnsembleStore
+
+
+# Version of the layout below, bump this if it changes
+cube_version: int = 1
+
+_cube_dtype = np.int32
+
+
+# Name of the index that sits alongside the cube
+def cube_index_name(cube_file: str) -> str:
+    return cube_file + ".json"
+
+
+# Write a cube from a set of run trajectories
+# runs are (design index, repeat, folder) as returned by list_ensemble_runs, trajectories are matching (days, wards)
+# arrays in the same order. Runs shorter than n_days are padded with zeros (MetaWards stops once nobody is infected)
+# and runs longer than n_days are cut short, the length of each run is kept in the index
+def write_cube(cube_file: str, runs: List[Tuple[int, int, str]], trajectories: Iterable[np.ndarray],
+               n_days: int, n_wards: int, mode_str: str = "x"):
+    if not runs:
+        raise ValueError("No runs to store")
+    if n_days < 1 or n_wards < 1:
+        raise ValueError("Cube must have at least one day and one ward")
+
+    # Create the file (honouring the mode) before handing it to numpy
+    with open(cube_file, mode_str + "b"):
+        pass
+    index: dict = {"version": cube_version, "shape": [len(runs), n_days, n_wards],
+                   "dtype": np.dtype(_cube_dtype).str, "runs": []}
+    limits = np.iinfo(_cube_dtype)
+    cube = np.memmap(cube_file, dtype=_cube_dtype, mode="w+", shape=(len(runs), n_days, n_wards))
+    try:
+        for run, ((design_index, repeat, folder), trajectory) in enumerate(zip(runs, trajectories)):
+            if trajectory.shape[1] != n_wards:
+                raise ValueError(f"Run {folder} has {trajectory.shape[1]} wards, expected {n_wards}")
+            if trajectory.size and (trajectory.min() < limits.min or trajectory.max() > limits.max):
+                raise ValueError(f"Run {folder} has values that are out of range for the cube")
+            days = min(trajectory.shape[0], n_days)
+            cube[run, 0:days, :] = trajectory[0:days]
+            cube[run, days:, :] = 0
+            index["runs"].append({"design_index": int(design_index), "repeat": int(repeat), "folder": folder,
+                                  "n_days": int(trajectory.shape[0])})
+        cube.flush()
+    finally:
+        del cube
+    with open(cube_index_name(cube_file), mode_str) as index_file:
+        js.dump(index, index_file, indent=4)
+
+
+# Write a cube holding every run in a store, the day axis is as long as the longest run
+def write_cube_from_store(cube_file: str, store: EnsembleStore, mode_str: str = "x"):
+    runs = store.runs
+    n_days = max(store.n_days(i) for i in range(len(store)))
+    write_cube(cube_file, runs, (store.read(i) for i in range(len(store))), n_days, store.n_wards, mode_str)
+
+
+# Read access to a cube
+# NOTE: Ward columns follow the trajectories, i.e. ward[FID] is held in column FID - 1
+class EnsembleCube:
+    def __init__(self, cube_file: str, mode: str = "r"):
+        self.file_name: str = cube_file
+        with open(cube_index_name(cube_file)) as index_file:
+            self.index: dict = js.load(index_file)
+        if self.index["version"] != cube_version:
+            raise ValueError(f"Unsupported ensemble cube version {self.index['version']}")
+        self.data: np.memmap = np.memmap(cube_file, dtype=np.dtype(self.index["dtype"]), mode=mode,
+                                         shape=tuple(self.index["shape"]))
+        self._folders: dict = {x["folder"]: i for i, x in enumerate(self.index["runs"])}
+
+    # Plain numpy indexing on the underlying (runs, days, wards) array
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.data.shape
+
+    # The (design index, repeat, folder) of every run, in cube order
+    @property
+    def runs(self) -> List[Tuple[int, int, str]]:
+        return [(x["design_index"], x["repeat"], x["folder"]) for x in self.index["runs"]]
+
+    # Look up a run by its MetaWards output folder name (see create_fingerprint)
+    def find_run(self, folder: str) -> Optional[int]:
+        return self._folders.get(folder)
+
+    # All the runs (repeats) of one design point
+    def design_runs(self, design_index: int) -> List[int]:
+        return [i for i, x in enumerate(self.index["runs"]) if x["design_index"] == design_index]
+
+    # Number of days that were actually recorded for a run, the rest of the day axis is padding
+    def n_days(self, run: int) -> int:
+        return self.index["runs"][run]["n_days"]
+
+    # A ward across runs and days, e.g. cube.ward(fid, days=slice(60, 151)) - this is a view, not a copy
+    def ward(self, fid: int, days: slice = slice(None), runs: slice = slice(None)) -> np.ndarray:
+        if not 1 <= fid <= self.data.shape[2]:
+            raise ValueError(f"Ward {fid} is not in the cube")
+        return self.data[runs, days, fid - 1]
+
+    # Every ward on one day, e.g. cube.day(80) - this is a view, not a copy
+    def day(self, day: int, runs: slice = slice(None)) -> np.ndarray:
+        return self.data[runs, day, :]
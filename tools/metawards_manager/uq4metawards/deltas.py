@@ -0,0 +1,39 @@
+#
+# Day on day delta encoding of ward output, as written by the extractors when .deltas is set
+#
+
+import numpy as np
+
+
+# Turns each day's ward values into the change since the previous day, one channel (S, E, I, R...) at a time
+# The previous day is copied into a buffer that is allocated once and re-used, so nothing aliases the workspace
+# (MetaWards refills the same workspace arrays every day) and no new arrays are made per day
+# Call reset() at the start of each run, the first day of a run is then written as-is (the change from zero)
+class DeltaEncoder:
+    def __init__(self, n_channels: int):
+        if n_channels < 1:
+            raise ValueError("Need at least one channel to encode")
+        self.n_channels: int = n_channels
+        self._previous: np.ndarray = np.zeros((n_channels, 0), dtype=np.int64)
+        self._deltas: np.ndarray = np.zeros((n_channels, 0), dtype=np.int64)
+
+    def reset(self):
+        self._previous[:] = 0
+
+    # Encode one channel for the current day, values can be anything numpy can view (e.g. workspace.I_in_wards)
+    # NOTE: The result is a view onto the internal buffer, it is only valid until the channel is next encoded
+    def encode(self, channel: int, values) -> np.ndarray:
+        values = np.asarray(values)
+        if self._previous.shape[1] != values.size:
+            dtype = np.promote_types(values.dtype, np.int64)
+            self._previous = np.zeros((self.n_channels, values.size), dtype=dtype)
+            self._deltas = np.zeros((self.n_channels, values.size), dtype=dtype)
+        np.subtract(values, self._previous[channel], out=self._deltas[channel])
+        self._previous[channel] = values
+        return self._deltas[channel]
+
+
+# Rebuild absolute values from deltas by summing along the day axis, e.g. axis=1 for a (runs, days, wards) array
+# Days missing from the end of a run should be zero deltas, which then hold the last value
+def decode_deltas(deltas: np.ndarray, axis: int = 0) -> np.ndarray:
+    return np.cumsum(deltas, axis=axis)
@@ -13,5 +13,10 @@ __design_methods: List[dict] = \
             "name": "latin_hypercube",
             "required_parameter_keys": [],
             "required_design_args": ["samples"]
+        },
+        {
+            "name": "maximin_lhs",
+            "required_parameter_keys": [],
+            "required_design_args": ["samples"]
         }
     ]
@@ -0,0 +1,63 @@
+#
+# Routines for finding and loading the runs of a MetaWards ensemble
+#
+
+import os
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+from .utils import create_fingerprint
+from .trajectory import read_trajectory
+
+
+# File name of the I per ward trajectory written by only_i_per_ward.py
+ward_trajectory_file_name: str = "wards_trajectory_I.csv.bz2"
+
+# The same, when written with .binary_trajectory (see uq4metawards.trajectory)
+ward_trajectory_binary_file_name: str = "wards_trajectory_I.bin"
+
+
+# Match every run of a design to its MetaWards output folder using the disease parameter fingerprint
+# Returns (design index, repeat, folder name) in design order, repeats are counted from 1 as in MetaWards
+def list_ensemble_runs(design_array: np.ndarray, disease_array: np.ndarray,
+                       sub_dir_list: List[str]) -> List[Tuple[int, int, str]]:
+    runs: List[Tuple[int, int, str]] = []
+    available = set(sub_dir_list)
+    for design_index, (design_row, disease_row) in enumerate(zip(design_array, disease_array)):
+
+        # Calculate how many runs match this design
+        metawards_vars = disease_row[0:len(disease_row) - 1].tolist()
+        repeats: int = int(design_row[len(design_row) - 1])
+
+        # Check that repeats is valid
+        if repeats < 1:
+            raise ValueError("Invalid number of repeats, design file might be corrupted")
+
+        # Try to find each output folder using metawards variable fingerprint
+        for r in range(repeats):
+            string: str = create_fingerprint(metawards_vars, r + 1, True)
+            if string not in available:
+                raise ValueError("Missing run data for: " + string)
+            runs.append((design_index, r + 1, string))
+    return runs
+
+
+# The trajectory file of a run, the binary one is used if the run has both
+def find_ward_trajectory(run_folder: str) -> str:
+    for name in [ward_trajectory_binary_file_name, ward_trajectory_binary_file_name + ".bz2"]:
+        file_name = os.path.join(run_folder, name)
+        if os.path.exists(file_name):
+            return file_name
+    return os.path.join(run_folder, ward_trajectory_file_name)
+
+
+# Load the I per ward trajectory of a single run as a (days, wards) integer array
+# Column k holds ward[k + 1], ward[0] is a placeholder in MetaWards and is dropped along with the other fields
+def load_ward_trajectory(run_folder: str) -> np.ndarray:
+    file_name = find_ward_trajectory(run_folder)
+    if ward_trajectory_binary_file_name in os.path.basename(file_name):
+        _, _, values = read_trajectory(file_name)
+        return values[:, 1:].astype(np.int64)
+    mw_out = pd.read_csv(file_name)
+    n_wards: int = sum(1 for x in mw_out.columns if x.startswith("ward[")) - 1
+    return mw_out[[f"ward[{x + 1}]" for x in range(n_wards)]].values.astype(np.int64)
@@ -0,0 +1,74 @@
+#
+# Lock-down schedules for the custom iterators
+#
+# The schedule is read from the user parameters (see lockdown_states.txt), with any number of phases k = 1, 2, ...
+#   .lockdown_date_<k>_year / _month / _day   the day that phase k starts, phases have to be in date order
+#   .lock_<k>_restrict                        scale_rate during phase k
+#   .lock_<k>_release                         or: release this fraction of the restriction of the phase before
+#   .can_work[k]                              whether people go to work in phase k, .can_work[0] is normal status
+# The schedule is compiled once per run into a table of (state, scale_rate, can_work) by simulation day
+#
+
+from datetime import date, timedelta
+from typing import List, Tuple
+
+
+class LockdownSchedule:
+    # start_days holds the first day of each phase, rates and can_work have an entry for phase 0 (normal) as well
+    def __init__(self, start_days: List[int], rates: List[float], can_work: list):
+        if len(rates) != len(start_days) + 1 or len(can_work) != len(start_days) + 1:
+            raise ValueError("Need a scale rate and can_work value for normal status and every lock-down phase")
+        if any(a > b for a, b in zip(start_days, start_days[1:])):
+            raise ValueError(f"Lock-down phases must be in date order, got start days {start_days}")
+
+        # One entry per day up to the start of the last phase, which then lasts until the end of the run
+        n_days = max([1] + [x + 1 for x in start_days])
+        self.table: List[tuple] = []
+        state = 0
+        for day in range(n_days):
+            while state < len(start_days) and day >= start_days[state]:
+                state += 1
+            self.table.append((state, rates[state], can_work[state]))
+
+    # (state, scale_rate, can_work) on a simulation day
+    def lookup(self, day: int) -> tuple:
+        return self.table[min(max(day, 0), len(self.table) - 1)]
+
+
+# Find the lock-down phases given in the user parameters, as (start date, scale_rate)
+def read_lockdown_phases(params: dict) -> List[Tuple[date, float]]:
+    phases: List[Tuple[date, float]] = []
+    rate = 1.0
+    k = 1
+    while f"lockdown_date_{k}_year" in params:
+        start = date(int(params[f"lockdown_date_{k}_year"]), int(params[f"lockdown_date_{k}_month"]),
+                     int(params[f"lockdown_date_{k}_day"]))
+        if f"lock_{k}_restrict" in params:
+            rate = float(params[f"lock_{k}_restrict"])
+        elif f"lock_{k}_release" in params:
+            rate = 1.0 - (1.0 - rate) * float(params[f"lock_{k}_release"])
+        else:
+            raise ValueError(f"Lock-down phase {k} needs either .lock_{k}_restrict or .lock_{k}_release")
+        phases.append((start, rate))
+        k += 1
+    return phases
+
+
+# Build the schedule of a run which has its day 0 on start_date
+def compile_lockdown(params: dict, start_date: date) -> LockdownSchedule:
+    phases = read_lockdown_phases(params)
+    can_work = list(params["can_work"])
+    if len(can_work) < len(phases) + 1:
+        raise ValueError(f"Got {len(phases)} lock-down phases but only {len(can_work)} .can_work entries")
+    return LockdownSchedule([(x[0] - start_date).days for x in phases], [1.0] + [x[1] for x in phases],
+                            can_work[:len(phases) + 1])
+
+
+# The schedule of the current run, compiled on the first call and then kept on the network parameters
+# NOTE: MetaWards makes new parameters for every run, so this is rebuilt whenever the user parameters change
+def get_lockdown_schedule(network, population) -> LockdownSchedule:
+    params = network.params
+    if not hasattr(params, "_uq4covid_lockdown"):
+        start_date = population.date - timedelta(days=population.day)
+        params._uq4covid_lockdown = compile_lockdown(params.user_params, start_date)
+    return params._uq4covid_lockdown
@@ -6,8 +6,14 @@
 import sys
 import os
 import argparse
+import math
+import operator
+import time
 import numpy as np
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial, reduce
+from typing import Iterable, Iterator, List, Optional, Union
 import pyDOE2
 import uq4metawards.utils
 from .jobfile import JobFile
@@ -48,32 +54,289 @@ def extract_variables_from_analysis(data: dict) -> (int, List[str]):
 #
 # Full factorial design matrices
 #
-def factorial_design(data: dict) -> (np.ndarray, str):
+# The design is never built as a whole unless asked for: rows are worked out from their index, in the same order as
+# pyDOE2.fullfact (the first column changes fastest), so any point or run of points can be made on its own
+#
+class FactorialDesign:
+    def __init__(self, states: List[np.ndarray]):
+        self.states = [np.asarray(x, dtype=np.float64) for x in states]
+        self.counts = [len(x) for x in self.states]
+        if not self.states or min(self.counts) < 1:
+            raise ValueError("Every factor needs at least one level")
+        self.n_points: int = reduce(operator.mul, self.counts, 1)
+        self.shape = (self.n_points, len(self.states))
+
+    def __len__(self) -> int:
+        return self.n_points
+
+    # The level of each factor for the points in index
+    def levels(self, index) -> tuple:
+        return np.unravel_index(index, self.counts, order="F")
+
+    # Points start to stop (not included) as a (points, factors) array
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        start, stop = max(start, 0), min(stop, self.n_points)
+        levels = self.levels(np.arange(start, max(start, stop)))
+        out = np.empty((len(levels[0]), len(self.states)))
+        for column, (states, level) in enumerate(zip(self.states, levels)):
+            out[:, column] = states[level]
+        return out
+
+    # The k-th point
+    def __getitem__(self, k: int) -> np.ndarray:
+        k = int(k)
+        if k < 0:
+            k += self.n_points
+        if k < 0 or k >= self.n_points:
+            raise IndexError(f"Design point {k} is out of range, the design has {self.n_points} points")
+        return self.rows(k, k + 1)[0]
+
+    # The whole design, in chunk_size blocks of points
+    def chunks(self, chunk_size: int = 65536) -> Iterator[np.ndarray]:
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be positive")
+        for start in range(0, self.n_points, chunk_size):
+            yield self.rows(start, start + chunk_size)
+
+    def to_array(self) -> np.ndarray:
+        return self.rows(0, self.n_points)
+
+
+def factorial_design_lazy(data: dict) -> (FactorialDesign, str):
     states, idents = extract_factors_from_analysis(data)
-    state_counts = [len(states[i]) for i, _ in enumerate(states)]
-    design = pyDOE2.fullfact(state_counts)
-    # Transform the designs back to real numbers
-    for i, row in enumerate(design):
-        design[i] = [states[index][int(item)] for index, item in enumerate(row)]
-    return design, ','.join(idents)
+    return FactorialDesign(states), ','.join(idents)
+
+
+def factorial_design(data: dict) -> (np.ndarray, str):
+    design, header = factorial_design_lazy(data)
+    return design.to_array(), header
 
 
 #
-# Latin hypercubes (really simple usage for now)
+# Latin hypercubes
 #
-# TODO: Extend this for more types from pyDOE2 and/or allow passing control arguments in
-# TODO: Look into adding a fixed seed input
+# method.args takes "samples" and optionally "seed" (for the same design every time), "criterion" and "iterations"
+# Without a criterion (or with "center") the hypercube is made a block of points at a time: each column is a random
+# permutation of the strata plus a random (or central) offset in each one, so large designs don't need to fit in
+# memory more than once. The space filling criteria ("maximin", "centermaximin", "correlation") compare every pair of
+# points so are left to pyDOE2, with the same seed, and are limited to _max_criterion_samples points
 #
-def latin_design(data: dict, num_samples=None) -> (np.ndarray, str):
+_lazy_criteria: List[Optional[str]] = [None, "center", "c"]
+_pydoe_criteria: List[str] = ["maximin", "m", "centermaximin", "cm", "correlation", "corr"]
+_max_criterion_samples: int = 20000
+
+
+class LatinHypercube:
+    def __init__(self, minimums: List[float], maximums: List[float], num_samples: int, seed: Optional[int] = None,
+                 center: bool = False):
+        if num_samples < 1:
+            raise ValueError("A Latin hypercube needs at least one sample")
+        self.minimums = np.asarray(minimums, dtype=np.float64)
+        self.maximums = np.asarray(maximums, dtype=np.float64)
+        self.n_points: int = int(num_samples)
+        self.shape = (self.n_points, len(self.minimums))
+        self.center = center
+
+        # Pick a seed if there isn't one so that every pass over the design gives the same points
+        self.seed: int = int(np.random.SeedSequence().entropy) if seed is None else int(seed)
+
+    def __len__(self) -> int:
+        return self.n_points
+
+    # The design on [0, 1], in chunk_size blocks of points
+    # NOTE: The random numbers are drawn in point order, so the design doesn't depend on the chunk size
+    def unit_chunks(self, chunk_size: int = 65536) -> Iterator[np.ndarray]:
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be positive")
+        rng = np.random.default_rng(self.seed)
+        strata = np.empty(self.shape, dtype=np.int64)
+        for column in range(self.shape[1]):
+            strata[:, column] = rng.permutation(self.n_points)
+        for start in range(0, self.n_points, chunk_size):
+            block = strata[start:start + chunk_size]
+            offset = 0.5 if self.center else rng.random(block.shape)
+            yield (block + offset) / self.n_points
+
+    # The design in the original ranges
+    def chunks(self, chunk_size: int = 65536) -> Iterator[np.ndarray]:
+        for unit in self.unit_chunks(chunk_size):
+            yield rescale_design(unit, self.minimums, self.maximums)
+
+    def to_array(self) -> np.ndarray:
+        return rescale_design(np.concatenate(list(self.unit_chunks())), self.minimums, self.maximums)
+
+
+# Move points on [0, 1] to [minimums, maximums], column by column
+def rescale_design(unit: np.ndarray, minimums, maximums) -> np.ndarray:
+    minimums = np.asarray(minimums, dtype=np.float64)
+    return minimums + (np.asarray(maximums, dtype=np.float64) - minimums) * unit
+
+
+def latin_design_lazy(data: dict, num_samples=None) -> (Union[np.ndarray, LatinHypercube], str):
     min_values, max_values, idents = extract_variables_from_analysis(data)
-    num_variables = len(idents)
+    args: dict = data["method"].get("args", {})
     if num_samples is None:
-        num_samples = data["method"]["args"]["samples"]
-    design = pyDOE2.lhs(n=num_variables, samples=num_samples)
-    # Transform the designs back to original ranges
-    for i, row in enumerate(design):
-        design[i] = [((max_values[i] - min_values[i]) * item) + min_values[i] for i, item in enumerate(row)]
-    return design, ','.join(idents)
+        num_samples = args["samples"]
+    seed = args.get("seed", None)
+    criterion = args.get("criterion", None)
+    if criterion is not None:
+        criterion = criterion.lower()
+
+    if criterion in _lazy_criteria:
+        return LatinHypercube(min_values, max_values, num_samples, seed, center=criterion is not None), \
+            ','.join(idents)
+    if criterion not in _pydoe_criteria:
+        raise ValueError(f"Unknown Latin hypercube criterion {criterion}, "
+                         f"pick from {_lazy_criteria[1:] + _pydoe_criteria}")
+    if num_samples > _max_criterion_samples:
+        raise ValueError(f"The {criterion} criterion compares every pair of points, so is limited to "
+                         f"{_max_criterion_samples} samples")
+    unit = pyDOE2.lhs(n=len(idents), samples=num_samples, criterion=criterion, iterations=args.get("iterations", None),
+                      random_state=seed)
+    return rescale_design(unit, min_values, max_values), ','.join(idents)
+
+
+def latin_design(data: dict, num_samples=None) -> (np.ndarray, str):
+    design, header = latin_design_lazy(data, num_samples)
+    if isinstance(design, LatinHypercube):
+        design = design.to_array()
+    return design, header
+
+
+#
+# Maximin Latin hypercubes
+#
+# Many seeded Latin hypercubes are scored by the smallest distance between any two of their points (on [0, 1]) and
+# the best is kept. Candidates are scored in parallel if method.args has "jobs" > 1, only the scores come back from
+# the workers and the winner is rebuilt from its seed, so the design is the same however many jobs are used
+# method.args takes "samples" and optionally "candidates", "seed", "jobs" and "block_size" (the rows of distances
+# worked out at once, which caps the memory used to block_size * samples)
+#
+
+# Smallest distance between any two rows of points, without building the whole distance matrix
+def min_pairwise_distance(points: np.ndarray, block_size: int = 1024) -> float:
+    if block_size < 1:
+        raise ValueError("Block size must be positive")
+    n_points = points.shape[0]
+    if n_points < 2:
+        return math.inf
+    squares = np.einsum("ij,ij->i", points, points)
+    best = math.inf
+    for start in range(0, n_points - 1, block_size):
+        stop = min(start + block_size, n_points)
+
+        # Only the pairs with the second point after the first, i.e. the upper triangle
+        block = points[start:stop]
+        distances = squares[start:stop, None] + squares[None, start:] - 2.0 * (block @ points[start:].T)
+        distances[np.tril_indices(stop - start, 0, distances.shape[1])] = np.inf
+        best = min(best, float(distances.min()))
+    return math.sqrt(max(best, 0.0))
+
+
+def _score_candidate(seed: int, num_variables: int, num_samples: int, block_size: int) -> float:
+    candidate = LatinHypercube([0.0] * num_variables, [1.0] * num_variables, num_samples, seed)
+    return min_pairwise_distance(candidate.to_array(), block_size)
+
+
+# Returns the best hypercube on [0, 1], its score and seed
+def maximin_search(num_variables: int, num_samples: int, candidates: int, seed: Optional[int] = None, jobs: int = 1,
+                   block_size: int = 1024) -> (np.ndarray, float, int):
+    if candidates < 1:
+        raise ValueError("Need at least one candidate design")
+    if jobs < 1:
+        raise ValueError("Need at least one job to score the designs")
+    seeds = [int(x) for x in np.random.SeedSequence(seed).generate_state(candidates)]
+    worker = partial(_score_candidate, num_variables=num_variables, num_samples=num_samples, block_size=block_size)
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as pool:
+        scores = list(pool.map(worker, seeds) if pool is not None else map(worker, seeds))
+
+    # The first of any equal scores wins, so this doesn't depend on the order the workers finish in
+    best = int(np.argmax(scores))
+    unit = LatinHypercube([0.0] * num_variables, [1.0] * num_variables, num_samples, seeds[best]).to_array()
+    return unit, scores[best], seeds[best]
+
+
+def maximin_design(data: dict) -> (np.ndarray, str):
+    min_values, max_values, idents = extract_variables_from_analysis(data)
+    args: dict = data["method"]["args"]
+    candidates = args.get("candidates", 100)
+    jobs = args.get("jobs", os.cpu_count() or 1)
+    start = time.perf_counter()
+    unit, score, seed = maximin_search(len(idents), args["samples"], candidates, args.get("seed", None), jobs,
+                                       args.get("block_size", 1024))
+    print(f"Maximin Latin hypercube: best of {candidates} candidates using {jobs} job(s) in "
+          f"{time.perf_counter() - start:.2f}s, minimum distance {score:.6f} (candidate seed {seed})")
+    return rescale_design(unit, min_values, max_values), ','.join(idents)
+
+
+#
+# Extending an existing design
+#
+# New points are added to a design that has already been run so that only they need to be run, the existing points
+# are never moved. Either the points are picked one at a time from a seeded Latin hypercube of candidates, each time
+# taking the candidate furthest from every point so far (existing and new), or the points with the largest emulator
+# variance are taken from a table of candidates, skipping any too close to the points so far
+#
+
+# Distance from each point to the nearest reference point, worked out block_size points at a time
+def min_distances_to(points: np.ndarray, reference: np.ndarray, block_size: int = 1024) -> np.ndarray:
+    if block_size < 1:
+        raise ValueError("Block size must be positive")
+    result = np.full(points.shape[0], np.inf)
+    if reference.shape[0] == 0:
+        return result
+    reference_squares = np.einsum("ij,ij->i", reference, reference)
+    for start in range(0, points.shape[0], block_size):
+        block = points[start:start + block_size]
+        distances = np.einsum("ij,ij->i", block, block)[:, None] + reference_squares[None, :] - \
+            2.0 * (block @ reference.T)
+        result[start:start + block_size] = np.sqrt(np.maximum(distances.min(axis=1), 0.0))
+    return result
+
+
+# Pick num_new of the candidates in turn, each time the one furthest from the points so far
+# Candidates that would be no further than min_distance from the points so far are never picked
+def _greedy_extension(existing: np.ndarray, candidates: np.ndarray, order: Optional[np.ndarray], num_new: int,
+                      min_distance: float, block_size: int) -> np.ndarray:
+    distances = min_distances_to(candidates, existing, block_size)
+    picked: List[int] = []
+    for _ in range(num_new):
+        allowed = np.flatnonzero(distances > min_distance)
+        if allowed.size == 0:
+            raise ValueError(f"Only {len(picked)} of the {num_new} new points are further than {min_distance} from "
+                             f"the rest of the design")
+
+        # Either the furthest candidate, or the first in the given order that is far enough away
+        best = int(allowed[np.argmax(distances[allowed])]) if order is None else int(order[np.isin(order, allowed)][0])
+        picked.append(best)
+        distances = np.minimum(distances, min_distances_to(candidates, candidates[best:best + 1], block_size))
+    return candidates[picked]
+
+
+# Maximin extension, the candidates are a Latin hypercube on [lower, upper] in every dimension
+def extend_maximin(existing: np.ndarray, num_new: int, num_candidates: Optional[int] = None,
+                   seed: Optional[int] = None, lower: float = -1.0, upper: float = 1.0,
+                   block_size: int = 1024) -> np.ndarray:
+    if num_new < 1:
+        raise ValueError("Need at least one new point")
+    if num_candidates is None:
+        num_candidates = max(1000, 100 * num_new)
+    if num_candidates < num_new:
+        raise ValueError("Need at least as many candidates as new points")
+    num_variables = existing.shape[1]
+    candidates = LatinHypercube([lower] * num_variables, [upper] * num_variables, num_candidates, seed).to_array()
+    return _greedy_extension(existing, candidates, None, num_new, 0.0, block_size)
+
+
+# Variance extension, the candidates are the points of an emulator variance table, taken largest variance first
+def extend_by_variance(existing: np.ndarray, points: np.ndarray, variances: np.ndarray, num_new: int,
+                       min_distance: float = 0.0, block_size: int = 1024) -> np.ndarray:
+    if num_new < 1:
+        raise ValueError("Need at least one new point")
+    if points.shape[1] != existing.shape[1]:
+        raise ValueError(f"The variance table has {points.shape[1]} variables but the design has {existing.shape[1]}")
+    order = np.argsort(-np.asarray(variances, dtype=np.float64), kind="stable")
+    return _greedy_extension(existing, np.asarray(points, dtype=np.float64), order, num_new, min_distance, block_size)
 
 
 # TODO: Put these external somewhere?
@@ -86,6 +349,10 @@ __design_function_mapping: List[dict] = \
         {
             "name": "latin_hypercube",
             "func": latin_design
+        },
+        {
+            "name": "maximin_lhs",
+            "func": maximin_design
         }
     ]
 
@@ -99,6 +366,33 @@ def process(data: dict) -> (np.ndarray, str):
     return algorithm["func"](data)
 
 
+# As process, but full factorial designs and Latin hypercubes are left lazy so that they can be streamed
+def process_lazy(data: dict) -> (Union[np.ndarray, FactorialDesign, LatinHypercube], str):
+    if data["method"]["algorithm"] == "full_factorial":
+        return factorial_design_lazy(data)
+    if data["method"]["algorithm"] == "latin_hypercube":
+        return latin_design_lazy(data)
+    return process(data)
+
+
+# A design in blocks of points, whether it is an array or a lazy design
+def iterate_design_chunks(design: Union[np.ndarray, FactorialDesign, LatinHypercube],
+                          chunk_size: int = 65536) -> Iterator[np.ndarray]:
+    if isinstance(design, (FactorialDesign, LatinHypercube)):
+        yield from design.chunks(chunk_size)
+    else:
+        for start in range(0, design.shape[0], chunk_size):
+            yield design[start:start + chunk_size]
+
+
+# Write a CSV a block of rows at a time, in the same format as np.savetxt
+def write_design_csv(file_name: str, chunks: Iterable[np.ndarray], header: str, fmt: str = "%f"):
+    with open(file_name, "w") as out_file:
+        out_file.write(header + "\n")
+        for chunk in chunks:
+            np.savetxt(out_file, chunk, fmt=fmt, delimiter=",")
+
+
 def main(argv):
     # Query the parser - is getattr() safer?
     in_location = argv.input
@@ -128,7 +422,10 @@ def main(argv):
     if not os.path.exists(out_location):
         os.makedirs(out_location)
 
-    design, header = process(analysis.description)
+    # Designs are written a block at a time, full factorial designs are never built as a whole
+    design, header = process_lazy(analysis.description)
+    if isinstance(design, LatinHypercube):
+        print(f"Latin hypercube seed: {design.seed}")
 
     # Save the epidemiology matrix only if doesn't exist or -f was passed
     if export_epidemiological_matrix:
@@ -138,13 +435,17 @@ def main(argv):
         if os.path.isfile(e_name) and not argv.force:
             print("Epidemiology matrix already exists, please run with -f to overwrite files")
         else:
-            np.savetxt(fname=e_name, X=design, fmt="%f", delimiter=",", header=header, comments='')
+            write_design_csv(e_name, iterate_design_chunks(design), header)
 
     # Transform the design into disease parameters
     num_outs = analysis.get_num_stream_outputs()
-    disease_matrix = np.zeros((design.shape[0], num_outs))
-    for i, row in enumerate(design):
-        disease_matrix[i] = uq4metawards.utils.transform_epidemiological_to_disease(row[0], row[1], row[2])
+
+    def disease_chunks() -> Iterator[np.ndarray]:
+        for chunk in iterate_design_chunks(design):
+            disease_matrix = np.zeros((chunk.shape[0], num_outs))
+            disease_matrix[:] = uq4metawards.utils.transform_epidemiological_to_disease_array(chunk[:, 0], chunk[:, 1],
+                                                                                               chunk[:, 2])
+            yield disease_matrix
 
     # Use the stream outputs to get the right variable idents
     var_names: List[str] = analysis.get_transform_variables()
@@ -156,7 +457,7 @@ def main(argv):
         print("Output already exists, please run with -f to overwrite files")
         sys.exit(1)
     else:
-        np.savetxt(fname=out_name, X=disease_matrix, fmt="%f", delimiter=",", header=disease_header, comments='')
+        write_design_csv(out_name, disease_chunks(), disease_header)
         sys.exit(0)
 
 
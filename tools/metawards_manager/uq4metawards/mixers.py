@@ -0,0 +1,64 @@
+#
+# Interaction matrix mixing for the multi-demographic models, a faster merge_using_matrix for sparse matrices
+#
+# merge_using_matrix sums every demographic into every row of the matrix, whatever is in it. Here the matrix is
+# turned into a list of (column, scale) terms for each row once, so zero rows are only cleared and zero terms are
+# skipped. The terms are added in the same order, so the FOIs come out exactly the same
+#
+
+import numpy as np
+from typing import Callable, Dict, Hashable, List, Sequence
+
+
+class MatrixMerger:
+    def __init__(self, matrix):
+        self.matrix = np.array(matrix, dtype=np.float64)
+        if self.matrix.ndim != 2 or self.matrix.shape[0] != self.matrix.shape[1]:
+            raise ValueError(f"The interaction matrix must be square, got shape {self.matrix.shape}")
+        self.rows = [(i, [(j, float(x)) for j, x in enumerate(row) if x != 0.0])
+                     for i, row in enumerate(self.matrix) if np.any(row != 0.0)]
+        self.zero_rows = [i for i, row in enumerate(self.matrix) if not np.any(row != 0.0)]
+        self._buffers: List[np.ndarray] = []
+
+    # Merge one set of FOIs (one array per demographic) in place
+    def merge_arrays(self, fois: Sequence[np.ndarray]):
+        if len(fois) != self.matrix.shape[0]:
+            raise ValueError(f"The interaction matrix is for {self.matrix.shape[0]} demographics, got {len(fois)}")
+        n = fois[0].shape[0]
+        if len(self._buffers) != len(self.rows) + 1 or self._buffers[0].shape[0] != n:
+            self._buffers = [np.empty(n) for _ in range(len(self.rows) + 1)]
+        scaled = self._buffers[-1]
+
+        # All rows are worked out before any are written back, as they read the original FOIs
+        for (i, terms), merged in zip(self.rows, self._buffers):
+            j, scale = terms[0]
+            np.multiply(fois[j], scale, out=merged)
+            for j, scale in terms[1:]:
+                np.multiply(fois[j], scale, out=scaled)
+                merged += scaled
+        for (i, _), merged in zip(self.rows, self._buffers):
+            fois[i][:] = merged
+        for i in self.zero_rows:
+            fois[i][:] = 0.0
+
+    # The merge function for MetaWards, used in place of merge_using_matrix
+    def merge(self, network, **kwargs):
+        subnets = network.subnets
+        if len(subnets) != self.matrix.shape[0]:
+            raise ValueError(f"The interaction matrix must be {len(subnets)}x{len(subnets)} for this network")
+        end = network.overall.nnodes + 1
+        self.merge_arrays([np.asarray(x.nodes.day_foi)[1:end] for x in subnets])
+        self.merge_arrays([np.asarray(x.nodes.night_foi)[1:end] for x in subnets])
+
+
+# The latest merger built in this process, keyed on whatever the matrix was built from (e.g. the user parameters)
+# NOTE: Only one is kept, each holds ward sized buffers and the key changes with every design point
+_mergers: Dict[Hashable, MatrixMerger] = {}
+
+
+# The merger for a key, make_matrix is only called when the key changes
+def get_matrix_merger(key: Hashable, make_matrix: Callable[[], list]) -> MatrixMerger:
+    if key not in _mergers:
+        _mergers.clear()
+        _mergers[key] = MatrixMerger(make_matrix())
+    return _mergers[key]
@@ -0,0 +1,167 @@
+#
+# Mover plans: the moves between disease stages / demographics given as a table, compiled once per run
+#
+# A plan is a list of (go_from, go_to, from_stage, to_stage, fraction) moves that are applied in order every day with
+# metawards.movers.go_stage. The fraction is a number, the name of a user parameter or a function of the user
+# parameters (a dict). Fractions are worked out and clamped to [0, 1] when the plan is compiled
+#
+# Moves are applied in sequence, so each one takes its fraction of whatever the moves before it left behind. Moving
+# people into another demographic must happen after that stage has been emptied for the day, otherwise they would
+# move twice, so a plan that moves into a stage of another demographic that a later move takes people out of is
+# rejected (within a demographic, e.g. E1 -> E2 then E2 -> I1, this is allowed as the models rely on it)
+#
+# Set .fused_movers to apply the whole plan with a single mover instead (see make_fused_mover). This is opt-in as it
+# draws from a different random stream: a run with the same seed follows a different trajectory to the go_stage
+# movers, the same in distribution but not number for number
+#
+
+import numpy as np
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+Fraction = Union[float, str, Callable[[dict], float]]
+Move = Tuple[str, str, int, int, Fraction]
+CompiledMove = Tuple[str, str, int, int, float]
+
+
+# Fraction of what is left once taken has already been moved out of a stage, e.g. the second of two moves out of I2
+# If nothing is left the fraction doesn't matter, so this is zero rather than a division by zero
+def of_remainder(fraction: float, taken: float) -> float:
+    if taken >= 1.0:
+        return 0.0
+    return fraction / (1.0 - taken)
+
+
+def _resolve_fraction(fraction: Fraction, user_params: dict) -> float:
+    if isinstance(fraction, str):
+        if fraction not in user_params:
+            raise ValueError(f"Missing user parameter .{fraction} needed by a mover")
+        return float(user_params[fraction])
+    if callable(fraction):
+        return float(fraction(user_params))
+    return float(fraction)
+
+
+# Check a plan and work out its fractions for one set of user parameters
+# demographics lists the names in the network, if given every move is checked against them
+def compile_plan(moves: Sequence[Move], user_params: dict,
+                 demographics: Optional[Sequence[str]] = None) -> List[CompiledMove]:
+    plan: List[CompiledMove] = []
+    for i, (go_from, go_to, from_stage, to_stage, fraction) in enumerate(moves):
+        name = f"move {i} ({go_from}[{from_stage}] -> {go_to}[{to_stage}])"
+        if from_stage < 0 or to_stage < 0:
+            raise ValueError(f"Negative stage in {name}")
+        if go_from == go_to and from_stage == to_stage:
+            raise ValueError(f"{name} doesn't go anywhere")
+        if demographics is not None and (go_from not in demographics or go_to not in demographics):
+            raise ValueError(f"Unknown demographic in {name}, the network has {list(demographics)}")
+        value = _resolve_fraction(fraction, user_params)
+        plan.append((go_from, go_to, int(from_stage), int(to_stage), min(max(value, 0.0), 1.0)))
+
+    for i, (go_from, go_to, _, to_stage, _) in enumerate(plan):
+        if go_from == go_to:
+            continue
+        later = [j for j in range(i + 1, len(plan)) if plan[j][0] == go_to and plan[j][2] == to_stage]
+        if later:
+            raise ValueError(f"Move {i} puts people into {go_to}[{to_stage}] but move {later[0]} takes them out "
+                             f"again on the same day, it has to come after")
+    return plan
+
+
+# Turn a compiled plan into the mover functions that MetaWards calls
+def make_movers(plan: Sequence[CompiledMove]) -> List[Callable]:
+    # NOTE: Imported here so that the rest of uq4metawards can be used without MetaWards installed
+    from metawards.movers import go_stage
+    return [partial(go_stage, go_from=go_from, go_to=go_to, from_stage=from_stage, to_stage=to_stage,
+                    fraction=fraction) for go_from, go_to, from_stage, to_stage, fraction in plan]
+
+
+# Apply a whole compiled plan, the moves are still made in order (so "operate on remainder" holds) but each one is a
+# few numpy operations on the wards that have anyone in the stage rather than a go_stage call
+# work and play hold the infection arrays by (demographic, stage), work_weight and play_weight the links weight and
+# nodes save_play_suscept arrays by demographic, all without the unused element 0
+# Draws are made in ward order, work then play, for each move. Empty wards don't use up random numbers, so this draws
+# the same numbers as moving every ward of one move after another with the same generator
+# Returns the demographics that people moved in or out of
+def apply_plan(plan: Sequence[CompiledMove], work: Dict[Tuple[str, int], np.ndarray],
+               play: Dict[Tuple[str, int], np.ndarray], work_weight: Dict[str, np.ndarray],
+               play_weight: Dict[str, np.ndarray], rng: np.random.Generator) -> Set[str]:
+    changed: Set[str] = set()
+    for go_from, go_to, from_stage, to_stage, fraction in plan:
+        if fraction == 0.0:
+            continue
+        for infections, weights in ((work, work_weight), (play, play_weight)):
+            source = infections[(go_from, from_stage)]
+            positive = source > 0
+            n_positive = np.count_nonzero(positive)
+            if n_positive == 0:
+                continue
+
+            # Pick out the occupied wards, unless there are so many that working on the whole array is quicker
+            if n_positive * 4 > source.size:
+                index = slice(None)
+                counts = np.where(positive, source, 0)
+            else:
+                index = np.flatnonzero(positive)
+                counts = source[index]
+            moved = counts if fraction == 1.0 else rng.binomial(counts, fraction)
+            source[index] -= moved
+            infections[(go_to, to_stage)][index] += moved
+            weights[go_from][index] -= moved
+            weights[go_to][index] += moved
+            changed.update([go_from, go_to])
+    return changed
+
+
+# The random numbers for the fused mover, a numpy generator per run seeded from the MetaWards generator so that runs
+# still follow the MetaWards seed
+def _get_generator(network, rngs) -> np.random.Generator:
+    params = network.params
+    if not hasattr(params, "_uq4covid_mover_rng"):
+        from metawards.utils import ran_int
+        params._uq4covid_mover_rng = np.random.default_rng(ran_int(int(rngs[0])))
+    return params._uq4covid_mover_rng
+
+
+# A single mover that applies a compiled plan, the populations of each demographic are only recalculated once at
+# the end rather than after every move
+# NOTE: The draws come from numpy rather than the MetaWards generator, so a run is the same as with the go_stage
+# movers in distribution but not number for number
+def make_fused_mover(plan: Sequence[CompiledMove]) -> Callable:
+    plan = list(plan)
+    names = sorted({x[0] for x in plan} | {x[1] for x in plan})
+    stages = sorted({(x[0], x[2]) for x in plan} | {(x[1], x[3]) for x in plan})
+
+    def go_plan(network, infections, rngs, profiler=None, **kwargs):
+        if not hasattr(network, "demographics"):
+            raise ValueError("The fused mover needs a network with demographics")
+        index = {x: network.demographics.get_index(x) for x in names}
+        subinfs = {x: infections.subinfs[index[x]] for x in names}
+        subnets = {x: network.subnets[index[x]] for x in names}
+        work = {(x, s): np.asarray(subinfs[x].work[s])[1:subinfs[x].nlinks + 1] for x, s in stages}
+        play = {(x, s): np.asarray(subinfs[x].play[s])[1:subinfs[x].nnodes + 1] for x, s in stages}
+        work_weight = {x: np.asarray(subnets[x].links.weight)[1:subinfs[x].nlinks + 1] for x in names}
+        play_weight = {x: np.asarray(subnets[x].nodes.save_play_suscept)[1:subinfs[x].nnodes + 1] for x in names}
+        for x in apply_plan(plan, work, play, work_weight, play_weight, _get_generator(network, rngs)):
+            subnets[x].recalculate_denominators(profiler=profiler)
+
+    return go_plan
+
+
+# The movers of a plan for the current run, compiled on the first call and then kept on the network parameters
+# NOTE: MetaWards makes new parameters for every run, so this is rebuilt for every design point
+def get_movers(network, name: str, moves: Sequence[Move]) -> List[Callable]:
+    params = network.params
+    if not hasattr(params, "_uq4covid_movers"):
+        params._uq4covid_movers = {}
+    cache: Dict[str, List[Callable]] = params._uq4covid_movers
+    if name not in cache:
+        demographics = [x.name for x in network.subnets] if hasattr(network, "subnets") else None
+        plan = compile_plan(moves, params.user_params, demographics)
+        if params.user_params.get("fused_movers", False):
+            from metawards.utils import Console
+            Console.print(f"{name} uses the fused mover, its random stream differs from the go_stage movers")
+            cache[name] = [make_fused_mover(plan)]
+        else:
+            cache[name] = make_movers(plan)
+    return list(cache[name])
@@ -0,0 +1,79 @@
+#
+# Bulk writes of ward output to a PostgreSQL results table
+#
+# Rows are streamed with COPY into a session-private staging table and then moved across with one set-based upsert,
+# so a whole day (or several days) of wards costs a handful of round trips rather than one per row
+#
+
+import io
+import numpy as np
+import psycopg2 as psg
+from psycopg2 import pool, sql
+from typing import List, Union
+
+
+# Connection pool shared by the writers in this process, made on first use
+_pool: Union[pool.ThreadedConnectionPool, None] = None
+
+
+# The pool is threaded so that a background writer (see uq4metawards.writebehind) can borrow connections too
+def get_pool(connection_params: dict, max_connections: int = 2) -> pool.ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = pool.ThreadedConnectionPool(1, max_connections, **connection_params)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+
+# Upserts blocks of integer rows into a table, the first len(key_columns) columns of each row are the key
+class CopyUpsertWriter:
+    def __init__(self, connection_pool: pool.AbstractConnectionPool, table_name: str, key_columns: List[str],
+                 value_columns: List[str]):
+        if not value_columns:
+            raise ValueError("Need at least one value column to write")
+        self.pool = connection_pool
+        self.table_name: str = table_name
+        self.key_columns: List[str] = key_columns
+        self.value_columns: List[str] = value_columns
+        columns = sql.SQL(",").join(sql.Identifier(x) for x in key_columns + value_columns)
+        table = sql.Identifier(table_name)
+        staging = sql.Identifier(f"{table_name}_staging")
+
+        # Temporary tables are never WAL logged and are private to the session, so no two processes share one
+        self._staging_query = sql.SQL("CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) "
+                                      "ON COMMIT DELETE ROWS;").format(staging, table)
+        self._copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv);").format(staging, columns)
+        self._upsert_query = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO UPDATE SET {};").format(
+            table, columns, columns, staging,
+            sql.SQL(",").join(sql.Identifier(x) for x in key_columns),
+            sql.SQL(",").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(x)) for x in value_columns))
+
+    # Send a (rows, keys + values) array in one transaction
+    def write(self, rows: np.ndarray):
+        if rows.shape[0] == 0:
+            return
+        if rows.shape[1] != len(self.key_columns) + len(self.value_columns):
+            raise ValueError(f"Rows have {rows.shape[1]} columns, expected "
+                             f"{len(self.key_columns) + len(self.value_columns)}")
+        buffer = io.StringIO()
+        np.savetxt(buffer, rows, fmt="%d", delimiter=",")
+        buffer.seek(0)
+
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(self._staging_query)
+                cursor.copy_expert(self._copy_query, buffer)
+                cursor.execute(self._upsert_query)
+            connection.commit()
+        except psg.Error:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.putconn(connection)
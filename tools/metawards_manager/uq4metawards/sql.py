@@ -2,8 +2,13 @@
 # SQL routines
 #
 
-from typing import List
+from itertools import repeat
+from typing import Callable, List, Set, Union
+import os
+import re
+import socket
 import sqlite3 as sql
+import numpy as np
 
 
 # The design table lists all the variables in the design header apart from the first and last
@@ -21,3 +26,247 @@ def make_design_table_schema(primary_key: str, design_vars: List[str], design_ta
     # Construct the table format schema string
     table_entries = f','.join(var_schema + check_schema)
     return f'create table {design_table_name} ( {table_entries} );'
+
+
+#
+# Array results schema: one row per (run, day, output channel) holding every ward value in a single blob
+# This replaces one row per ward with one row per ward vector, i.e. ~8,500 times fewer rows for England & Wales
+#
+
+array_results_table_name: str = "results_array_table"
+
+array_results_insert: str = f"insert into {array_results_table_name}" \
+                            "(run_id,sim_time,output_channel,dtype,ward_values) values (?,?,?,?,?)"
+
+
+# Table for the packed ward arrays, keyed on (run, day, channel) so there is no separate row id to store
+def make_array_results_schema(output_table_name: str, day_table_name: str, run_table_name: str) -> str:
+    return f"create table {array_results_table_name}(run_id integer not null,sim_time integer not null," \
+           "output_channel integer not null,dtype text not null,ward_values blob not null," \
+           "primary key (run_id,sim_time,output_channel)," \
+           f"foreign key (output_channel) references {output_table_name}(id)," \
+           f"foreign key (sim_time) references {day_table_name}(day)," \
+           f"foreign key (run_id) references {run_table_name}(run_index)) without rowid;"
+
+
+# Pack a MetaWards ward array (index 0 is unused, so ward[1..n] is stored) into a dtype string and a blob
+# Values are stored little-endian so that a database can be moved between machines
+def pack_ward_array(ward_values) -> (str, bytes):
+    values = np.asarray(ward_values)[1:]
+    values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+    return values.dtype.str, values.tobytes()
+
+
+# The inverse of pack_ward_array, element k of the result is ward[k + 1]
+def unpack_ward_array(dtype: str, blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.dtype(dtype))
+
+
+# Look up the index of a named output channel, e.g. "infected"
+def get_output_channel(database: sql.Connection, channel: str) -> int:
+    row = database.execute("select id from output_table where name = ?", (channel,)).fetchone()
+    if row is None:
+        raise ValueError(f"No output channel called {channel}")
+    return row[0]
+
+
+# Read one channel of one run back as a (days, wards) array, along with the day of each row
+# Column k holds ward[k + 1], the same layout as the run trajectories read by uq4
+def read_run_channel(database: sql.Connection, run_id: int, channel: str) -> (np.ndarray, np.ndarray):
+    rows = database.execute(f"select sim_time,dtype,ward_values from {array_results_table_name} "
+                            f"where run_id = ? and output_channel = ? order by sim_time",
+                            (run_id, get_output_channel(database, channel))).fetchall()
+    if not rows:
+        raise ValueError(f"No {channel} output for run {run_id}")
+    days = np.array([x[0] for x in rows], dtype=int)
+    return days, np.stack([unpack_ward_array(x[1], x[2]) for x in rows])
+
+
+# Read one channel of every run as a (runs, days, wards) array, with the run ids and days along the first two axes
+# Days that a run didn't reach are left as zero
+def read_channel(database: sql.Connection, channel: str) -> (np.ndarray, np.ndarray, np.ndarray):
+    channel_id = get_output_channel(database, channel)
+    runs = np.array([x[0] for x in database.execute(f"select distinct run_id from {array_results_table_name} "
+                                                    f"where output_channel = ? order by run_id", (channel_id,))],
+                    dtype=int)
+    days = np.array([x[0] for x in database.execute(f"select distinct sim_time from {array_results_table_name} "
+                                                    f"where output_channel = ? order by sim_time", (channel_id,))],
+                    dtype=int)
+    if runs.size == 0:
+        raise ValueError(f"No {channel} output in the database")
+    result: Union[np.ndarray, None] = None
+    for run_id, day, dtype, blob in database.execute(f"select run_id,sim_time,dtype,ward_values "
+                                                     f"from {array_results_table_name} where output_channel = ?",
+                                                     (channel_id,)):
+        values = unpack_ward_array(dtype, blob)
+        if result is None:
+            result = np.zeros((runs.size, days.size, values.size), dtype=values.dtype)
+        result[np.searchsorted(runs, run_id), np.searchsorted(days, day)] = values
+    return runs, days, result
+
+
+#
+# Sharded ensemble databases: every MetaWards worker process writes its runs to its own file, so no process ever
+# waits on another's lock. The shards are stitched together into one database after the ensemble has finished
+#
+
+ensemble_database_name: str = "sql_wards.dat"
+
+_shard_pattern = re.compile(r"^sql_wards\.(.+)\.(\d+)\.dat$")
+
+
+# Name of the shard for this process, the host is included in case several machines share the output folder
+def shard_file_name(out_folder: str, pid: Union[int, None] = None) -> str:
+    if pid is None:
+        pid = os.getpid()
+    return os.path.join(out_folder, f"sql_wards.{socket.gethostname()}.{pid}.dat")
+
+
+# All the shards in an output folder, sorted so that merging is repeatable
+def find_shards(out_folder: str) -> List[str]:
+    return sorted(os.path.join(out_folder, x) for x in os.listdir(out_folder) if _shard_pattern.match(x))
+
+
+# Delete a merged shard along with anything sqlite left beside it (shards are written in WAL mode)
+# The WAL is checkpointed back into the shard first, so nothing is left behind even if it was not closed cleanly
+def remove_shard(shard_file: str):
+    shard = sql.connect(shard_file)
+    try:
+        shard.execute("PRAGMA journal_mode = DELETE;")
+    finally:
+        shard.close()
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(shard_file + suffix):
+            os.remove(shard_file + suffix)
+
+
+# Statements are kept as constants so that sqlite re-uses the compiled versions
+_insert_run_sql: str = "insert into run_table(design_index,end_day,mw_folder) values (?,?,?)"
+_insert_day_sql: str = "insert or ignore into day_table(day,date) values (?,?)"
+_insert_result_sql: str = "insert into results_table(ward_id,output_channel,sim_out,sim_time,run_id) " \
+                          "values (?,?,?,?,?)"
+_update_run_sql: str = "update run_table set end_day = ? where run_index = ?"
+
+
+# Setup entries which are written once per run, returns the index of the run
+def write_setup_entries(database: sql.Connection, design_index: int, run_ident: str) -> int:
+    run_index = database.execute(_insert_run_sql, (design_index, -1, run_ident)).lastrowid
+    database.commit()
+    return run_index
+
+
+# Everything that an extractor writes to its shard, this lives on the write-behind thread (see uq4metawards.writebehind)
+# One connection is kept open per process and re-used by every run that the process is given
+# Days are buffered and written every flush_days days in a single transaction, and whatever is left when the run is
+# finalised (flush) or the next run starts
+class ShardSink:
+    def __init__(self, file_name: str, log: Callable[[str], None] = print):
+        # WAL mode lets the shard be read (e.g. to check progress) while this process is still writing to it
+        self.connection: sql.Connection = sql.connect(file_name, timeout=60.0)
+        self.connection.execute("PRAGMA journal_mode = WAL;")
+        self.connection.execute("PRAGMA synchronous = NORMAL;")
+        self.log = log
+        self.run_index: int = -1  # Which run this currently is
+        self.array_schema: bool = False
+        self.flush_days: int = 10
+        self.pending_days: List[tuple] = []
+        self.pending_results: List[tuple] = []
+        self.end_day: int = -1
+
+    # Anything left from the previous run in this process is written against that run
+    def start_run(self, design_index: int, run_ident: str, array_schema: bool, flush_days: int):
+        self.flush()
+        self.array_schema = array_schema
+        self.flush_days = flush_days
+        self.run_index = write_setup_entries(self.connection, design_index, run_ident)
+        self.log("This is run: " + str(self.run_index))
+
+    # Buffer one day, values is a (channels, wards + 1) snapshot of the output channels
+    def add_day(self, day: int, date: str, values: np.ndarray):
+        # Some runs may be longer / shorter, so duplicate days are ignored when written
+        self.pending_days.append((day, date))
+        for channel_index in range(values.shape[0]):
+            if self.array_schema:
+                self.pending_results.append((self.run_index, day, channel_index) +
+                                            pack_ward_array(values[channel_index]))
+            else:
+                # NOTE: tolist() hands sqlite plain ints, it can't bind numpy integers
+                self.pending_results.extend(zip(range(1, values.shape[1]), repeat(channel_index),
+                                                values[channel_index, 1:].tolist(), repeat(day),
+                                                repeat(self.run_index)))
+
+        # Last day for the run table, then write out if enough days have built up
+        self.end_day = day
+        if len(self.pending_days) >= self.flush_days:
+            self.flush()
+
+    # Send everything that has been buffered to the database in a single transaction
+    def flush(self):
+        if not self.pending_days:
+            return
+        with self.connection:
+            self.connection.executemany(_insert_day_sql, self.pending_days)
+            self.connection.executemany(array_results_insert if self.array_schema else _insert_result_sql,
+                                        self.pending_results)
+            self.connection.execute(_update_run_sql, (self.end_day, self.run_index))
+        self.pending_days = []
+        self.pending_results = []
+
+    # Last chance to write anything left over when the process exits
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+# Names of the tables in a database (or an attached schema)
+def _table_names(database: sql.Connection, schema: str = "main") -> Set[str]:
+    return {x[0] for x in database.execute(f"select name from {schema}.sqlite_master where type = 'table'")}
+
+
+# Merge a set of shards into one database
+# The first shard is copied as-is (design, output channels, days and its runs), every other shard is attached and
+# copied over with set-based inserts. Run indices are offset so that they stay unique, results follow their run
+def merge_shards(database_file: str, shard_files: List[str], mode_str: str = "x"):
+    if not shard_files:
+        raise ValueError("No shards to merge")
+
+    # Create the file (honouring the mode) before handing it to sqlite
+    with open(database_file, mode_str + "b"):
+        pass
+    database: Union[sql.Connection, None] = None
+    try:
+        database = sql.connect(database_file)
+        first = sql.connect(shard_files[0])
+        try:
+            first.backup(database)
+        finally:
+            first.close()
+        database.execute("PRAGMA journal_mode = OFF;")
+        database.execute("PRAGMA synchronous = OFF;")
+        tables = _table_names(database)
+
+        for shard_file in shard_files[1:]:
+            database.execute("attach database ? as shard", (shard_file,))
+            try:
+                if _table_names(database, "shard") != tables:
+                    raise ValueError(f"{shard_file} does not have the same tables as {shard_files[0]}")
+                with database:
+                    offset = database.execute("select coalesce(max(run_index), 0) from run_table").fetchone()[0]
+                    database.execute("insert or ignore into day_table(day,date) select day,date from shard.day_table")
+                    database.execute("insert into run_table(run_index,design_index,end_day,mw_folder) "
+                                     "select run_index + ?,design_index,end_day,mw_folder from shard.run_table",
+                                     (offset,))
+                    if "results_table" in tables:
+                        database.execute("insert into results_table(ward_id,output_channel,sim_out,sim_time,run_id) "
+                                         "select ward_id,output_channel,sim_out,sim_time,run_id + ? "
+                                         "from shard.results_table", (offset,))
+                    if array_results_table_name in tables:
+                        database.execute(f"insert into {array_results_table_name}"
+                                         "(run_id,sim_time,output_channel,dtype,ward_values) "
+                                         "select run_id + ?,sim_time,output_channel,dtype,ward_values "
+                                         f"from shard.{array_results_table_name}", (offset,))
+            finally:
+                database.execute("detach database shard")
+    finally:
+        if database:
+            database.close()
@@ -0,0 +1,17 @@
+#
+# Disease stage tables for the multi-demographic ward extractors
+#
+
+import numpy as np
+
+
+# Stack the per-stage ward totals of one demographic (ward_inf_tot) into a (stages, wards + 1) array
+# Column 0 is the unused MetaWards ward, as with the workspace arrays
+# Stages 1 and 3 have the stage before them added on, this is the rule the ward extractors have always used
+# TODO: Why are some classes deltas?
+def stage_matrix(ward_inf_tot, n_inf_classes: int) -> np.ndarray:
+    stages = np.array([np.asarray(ward_inf_tot[j]) for j in range(n_inf_classes)], dtype=np.int64)
+    for j in (1, 3):
+        if j < n_inf_classes:
+            stages[j] += stages[j - 1]
+    return stages
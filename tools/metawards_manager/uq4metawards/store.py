@@ -0,0 +1,122 @@
+#
+# Columnar ensemble store: every run trajectory of an ensemble packed into one chunked binary file
+#
+# The store is a zip file holding an index plus one compressed .npy chunk per (run, block of days, block of wards)
+# Reading a slice only decompresses the chunks that it touches, so single days or wards are cheap
+#
+
+import json as js
+import zipfile
+import numpy as np
+from typing import List, Tuple, Iterable, Optional
+
+
+# Version of the layout below, bump this if it changes
+store_version: int = 1
+
+_index_name: str = "index.json"
+_store_dtype = np.int32
+
+
+# Member name of a single chunk
+def _chunk_name(run: int, day_chunk: int, ward_chunk: int) -> str:
+    return f"run{run}/day{day_chunk}/ward{ward_chunk}.npy"
+
+
+# Pack a set of run trajectories into a store
+# runs are (design index, repeat, folder) as returned by list_ensemble_runs, trajectories are matching (days, wards)
+# arrays in the same order (this can be a generator so that only one trajectory is held at a time)
+def write_store(store_file: str, runs: List[Tuple[int, int, str]], trajectories: Iterable[np.ndarray],
+                day_chunk: int = 32, ward_chunk: int = 1024, mode_str: str = "x"):
+    if day_chunk < 1 or ward_chunk < 1:
+        raise ValueError("Chunk sizes must be positive")
+    index: dict = {"version": store_version, "n_wards": None, "day_chunk": day_chunk, "ward_chunk": ward_chunk,
+                   "dtype": np.dtype(_store_dtype).str, "runs": []}
+    limits = np.iinfo(_store_dtype)
+    with zipfile.ZipFile(store_file, mode_str, compression=zipfile.ZIP_DEFLATED, allowZip64=True) as store:
+        for run, ((design_index, repeat, folder), trajectory) in enumerate(zip(runs, trajectories)):
+            if index["n_wards"] is None:
+                index["n_wards"] = int(trajectory.shape[1])
+            elif trajectory.shape[1] != index["n_wards"]:
+                raise ValueError(f"Run {folder} has {trajectory.shape[1]} wards, expected {index['n_wards']}")
+            if trajectory.size and (trajectory.min() < limits.min or trajectory.max() > limits.max):
+                raise ValueError(f"Run {folder} has values that are out of range for the store")
+            trajectory = trajectory.astype(_store_dtype)
+            for d in range(0, trajectory.shape[0], day_chunk):
+                for w in range(0, trajectory.shape[1], ward_chunk):
+                    with store.open(_chunk_name(run, d // day_chunk, w // ward_chunk), "w", force_zip64=True) as f:
+                        np.lib.format.write_array(f, np.ascontiguousarray(trajectory[d:d + day_chunk,
+                                                                                     w:w + ward_chunk]))
+            index["runs"].append({"design_index": int(design_index), "repeat": int(repeat), "folder": folder,
+                                  "n_days": int(trajectory.shape[0])})
+        if index["n_wards"] is None:
+            raise ValueError("No runs to store")
+        store.writestr(_index_name, js.dumps(index, indent=4))
+
+
+# Read access to a store, slices are assembled from the chunks they overlap
+class EnsembleStore:
+    def __init__(self, store_file: str):
+        self.file_name: str = store_file
+        self._zip = zipfile.ZipFile(store_file, "r")
+        try:
+            self.index: dict = js.loads(self._zip.read(_index_name))
+        except KeyError:
+            self._zip.close()
+            raise ValueError(f"{store_file} is not an ensemble store")
+        if self.index["version"] != store_version:
+            self._zip.close()
+            raise ValueError(f"Unsupported ensemble store version {self.index['version']}")
+        self._folders: dict = {x["folder"]: i for i, x in enumerate(self.index["runs"])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    # Number of runs held
+    def __len__(self) -> int:
+        return len(self.index["runs"])
+
+    @property
+    def n_wards(self) -> int:
+        return self.index["n_wards"]
+
+    # The (design index, repeat, folder) of every run, in store order
+    @property
+    def runs(self) -> List[Tuple[int, int, str]]:
+        return [(x["design_index"], x["repeat"], x["folder"]) for x in self.index["runs"]]
+
+    # Look up a run by its MetaWards output folder name
+    def find_run(self, folder: str) -> Optional[int]:
+        return self._folders.get(folder)
+
+    # Number of days recorded for a run
+    def n_days(self, run: int) -> int:
+        return self.index["runs"][run]["n_days"]
+
+    # Read a (days, wards) block of a run, the slices are clipped to the run like normal array slicing
+    def read(self, run: int, days: slice = slice(None), wards: slice = slice(None)) -> np.ndarray:
+        day_chunk: int = self.index["day_chunk"]
+        ward_chunk: int = self.index["ward_chunk"]
+        d0, d1, d_step = days.indices(self.n_days(run))
+        w0, w1, w_step = wards.indices(self.n_wards)
+        if d_step < 1 or w_step < 1:
+            raise ValueError("Store slices must run forwards")
+        d1 = max(d1, d0)
+        w1 = max(w1, w0)
+        block = np.empty((d1 - d0, w1 - w0), dtype=np.dtype(self.index["dtype"]))
+        for dc in range(d0 // day_chunk, (d1 + day_chunk - 1) // day_chunk):
+            for wc in range(w0 // ward_chunk, (w1 + ward_chunk - 1) // ward_chunk):
+                with self._zip.open(_chunk_name(run, dc, wc)) as f:
+                    chunk = np.lib.format.read_array(f)
+                # Overlap of this chunk with the requested block, in run coordinates
+                cd0, cw0 = dc * day_chunk, wc * ward_chunk
+                a0, a1 = max(d0, cd0), min(d1, cd0 + chunk.shape[0])
+                b0, b1 = max(w0, cw0), min(w1, cw0 + chunk.shape[1])
+                block[a0 - d0:a1 - d0, b0 - w0:b1 - w0] = chunk[a0 - cd0:a1 - cd0, b0 - cw0:b1 - cw0]
+        return block[::d_step, ::w_step]
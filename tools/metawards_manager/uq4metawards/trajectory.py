@@ -0,0 +1,75 @@
+#
+# Binary ward trajectories: a small header followed by one fixed-width int32 record per day
+#
+# Layout (little-endian):
+#   magic "UQ4T", uint32 version, uint32 header length, JSON header padded with spaces to a multiple of 4 bytes
+#   then for every day: int32 day, int32 value for each of the n_values wards (ward 0 included, as in MetaWards)
+# The JSON header holds n_values, the first day / date and the design parameters of the run, so they are only
+# written once. Records are appended as the run goes, a partly written last record (e.g. a crashed run) is ignored
+#
+
+import bz2
+import json as js
+import struct
+import numpy as np
+from typing import BinaryIO, Dict, List, Sequence, Tuple
+
+# Version of the layout above, bump this if it changes
+trajectory_version: int = 1
+
+_magic: bytes = b"UQ4T"
+_prefix = struct.Struct("<4sII")
+_day = struct.Struct("<i")
+_record_dtype = np.dtype("<i4")
+
+
+# Write the header of a new trajectory file, values per day is fixed from here on
+def write_trajectory_header(file: BinaryIO, n_values: int, first_day: int, first_date: str,
+                            design_names: Sequence[str], design_values: Sequence[float]):
+    if len(design_names) != len(design_values):
+        raise ValueError(f"Got {len(design_values)} design values for {len(design_names)} names")
+    header = {"n_values": int(n_values), "first_day": int(first_day), "first_date": str(first_date),
+              "design": dict(zip(design_names, [float(x) for x in design_values]))}
+    text = js.dumps(header).encode("utf-8")
+    text += b" " * (-len(text) % 4)
+    file.write(_prefix.pack(_magic, trajectory_version, len(text)))
+    file.write(text)
+
+
+# Append one day, values is anything numpy can view as int32 (e.g. the workspace arrays, which are not copied)
+def write_trajectory_day(file: BinaryIO, day: int, values):
+    file.write(_day.pack(day))
+    file.write(np.asarray(values, dtype=_record_dtype).tobytes())
+
+
+# Split the contents of a trajectory file into its header and the raw records
+def _parse(data: bytes, file_name: str) -> Tuple[dict, np.ndarray]:
+    if len(data) < _prefix.size:
+        raise ValueError(f"{file_name} is too short to be a trajectory file")
+    magic, version, header_length = _prefix.unpack_from(data)
+    if magic != _magic:
+        raise ValueError(f"{file_name} is not a trajectory file")
+    if version != trajectory_version:
+        raise ValueError(f"{file_name} is trajectory version {version}, can only read version {trajectory_version}")
+    start = _prefix.size + header_length
+    header = js.loads(data[_prefix.size:start].decode("utf-8"))
+    width = header["n_values"] + 1
+    n_records = (len(data) - start) // (width * _record_dtype.itemsize)
+    records = np.frombuffer(data, dtype=_record_dtype, count=n_records * width, offset=start)
+    return header, records.reshape(n_records, width)
+
+
+# Read a trajectory file (optionally bz2 compressed)
+# Returns the header, the day of each record and the (records, n_values) values
+def read_trajectory(file_name: str) -> Tuple[dict, np.ndarray, np.ndarray]:
+    opener = bz2.open if file_name.endswith(".bz2") else open
+    with opener(file_name, "rb") as file:
+        data = file.read()
+    header, records = _parse(data, file_name)
+    return header, records[:, 0], records[:, 1:]
+
+
+# The design parameters of a trajectory as (names, values)
+def trajectory_design(header: dict) -> Tuple[List[str], List[float]]:
+    design: Dict[str, float] = header["design"]
+    return list(design.keys()), list(design.values())
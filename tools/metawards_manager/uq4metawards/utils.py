@@ -1,9 +1,11 @@
 # Handy utility functions for the analysis manager
 
 import os
+import csv
 import numpy as np
 import json as js
-from typing import List, Any
+from itertools import islice
+from typing import List, Any, Iterable, Iterator
 #from metawards import Disease
 from dataclasses import asdict
 
@@ -58,30 +60,48 @@ def contains_required_keys(data: dict, required_keys: List[Any]) -> bool:
 #    return disease_data
 
 
-# Convert epidemiological parameters to disease variables
-# TODO: This could be vectorised (by using numpy.ndarray), but I doubt it is worth it
-def transform_epidemiological_to_disease(incubation, infect_time, r_zero) -> (float, float, float, float, float):
+# Convert columns of epidemiological parameters to disease variables
+# Every row is validated up front so that a bad design reports all of the offending rows in one go
+# Returns an (n, 5) matrix with columns beta[2], beta[3], progress[1], progress[2], progress[3]
+def transform_epidemiological_to_disease_array(incubation, infect_time, r_zero) -> np.ndarray:
+    incubation = np.atleast_1d(np.asarray(incubation, dtype=float))
+    infect_time = np.atleast_1d(np.asarray(infect_time, dtype=float))
+    r_zero = np.atleast_1d(np.asarray(r_zero, dtype=float))
+    if not incubation.shape == infect_time.shape == r_zero.shape or incubation.ndim != 1:
+        raise ValueError("Epidemiological parameters must be columns of the same length")
+
     # TODO: Check these validations are correct
-    if not incubation > 0.0:
-        raise ValueError("Invalid incubation time")
-    if not infect_time > 0.0:
-        raise ValueError("Invalid infectious period")
-    if r_zero < 0.0:
-        raise ValueError("Invalid R0")
+    # NOTE: The comparisons are negated so that NaN entries are caught as well
+    checks = [(~(incubation > 0.0), "Invalid incubation time"),
+              (~(infect_time > 0.0), "Invalid infectious period"),
+              (r_zero < 0.0, "Invalid R0")]
+    errors: List[str] = [f"{message} in rows {np.flatnonzero(mask).tolist()}" for mask, message in checks
+                         if mask.any()]
+    if errors:
+        raise ValueError("; ".join(errors))
 
     beta = r_zero / infect_time
     inv_incu = 1.0 / incubation
-    inv_inf = 1.0 / infect_time
-    # Quadratic parameters for dt
-    quad_a = (beta * inv_incu) - (inv_inf * inv_incu)
-    quad_b = inv_inf + inv_incu
-    quad_c = -1.0
-    disc = np.sqrt((quad_b ** 2) - (4.0 * quad_a * quad_c))
-    dt = np.log(2.0) * (((-beta) + disc) / (2.0 * quad_a))
+    # NOTE: The doubling time is not part of the output, so it isn't calculated here
     # Split infection periods
     ip1 = 1.0
     ip2 = infect_time - ip1
-    return beta, beta, inv_incu, 1.0 / ip1, 1.0 / ip2
+    disease = np.empty((incubation.shape[0], 5))
+    disease[:, 0] = beta
+    disease[:, 1] = beta
+    disease[:, 2] = inv_incu
+    disease[:, 3] = 1.0 / ip1
+    disease[:, 4] = 1.0 / ip2
+    return disease
+
+
+# Convert epidemiological parameters to disease variables
+# This is a single row of the array version above, kept for scripts that work a row at a time
+def transform_epidemiological_to_disease(incubation, infect_time, r_zero) -> (float, float, float, float, float):
+    if not all(np.ndim(x) == 0 for x in (incubation, infect_time, r_zero)):
+        raise ValueError("Epidemiological parameters must be single values, use "
+                         "transform_epidemiological_to_disease_array for columns")
+    return tuple(transform_epidemiological_to_disease_array(incubation, infect_time, r_zero)[0].tolist())
 
 
 # Output a dictionary to a json file and manage some common exceptions
@@ -125,6 +145,25 @@ def scale_matrix_columns(matrix: np.ndarray, min_col, max_col) -> np.ndarray:
     return np.add(np.multiply(matrix, np.subtract(max_col, min_col)), min_col)
 
 
+# Split an iterable (e.g. a csv.reader) into lists of at most chunk_size items without reading any further ahead
+def iterate_chunks(rows: Iterable, chunk_size: int) -> Iterator[list]:
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be positive")
+    rows = iter(rows)
+    chunk = list(islice(rows, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, chunk_size))
+
+
+# Stream the rows of a csv file after the header, the file is only held open while iterating
+def iterate_csv_body(location: str) -> Iterator[List[str]]:
+    with open(location, newline='') as handle:
+        reader = csv.reader(handle)
+        next(reader, None)
+        yield from reader
+
+
 # Print iterations progress - designed to be called in a loop with no interleaved printing
 # A nice fill character is █ (ascii: 219)
 def print_progress_bar(iteration: int, total: int, prefix: str = '', suffix: str = '', decimals: int = 1,
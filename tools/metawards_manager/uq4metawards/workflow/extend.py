@@ -0,0 +1,128 @@
+#
+# extend.py: Adds new points to a design that has already been run, so that an ensemble can be topped up
+#
+# The design is the hypercube on [-1, 1] that pre.py reads, the existing rows are copied across as they are so their
+# design indices (and MetaWards line numbers) don't change, and the new points are added at the end
+# Only the new lines then need to be run, e.g. metawards -l <first>-<last> with the disease file from pre.py
+#
+
+import sys
+import os
+import argparse
+import csv
+import numpy as np
+from typing import List
+from uq4metawards.make_design import extend_maximin, extend_by_variance, min_pairwise_distance
+
+
+# NOTE: If you use argv as a parameter to main, you will have problems with the package setup entry points
+def main():
+    argv = main_parser()
+
+    design_location: str = argv.design
+    out_location: str = argv.output
+    if argv.points < 1:
+        print("Need at least one new point")
+        sys.exit(1)
+    if os.path.abspath(design_location) == os.path.abspath(out_location):
+        print("The extended design must be written to a new file")
+        sys.exit(1)
+
+    # The last column is the number of repeats, everything else is the hypercube
+    try:
+        with open(design_location, newline='') as design_file:
+            design_text = design_file.read()
+        rows: List[List[str]] = [x for x in csv.reader(design_text.splitlines()) if x]
+    except IOError as error:
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
+        sys.exit(1)
+
+    design_names: List[str] = rows[0]
+    if len(design_names) < 2:
+        print("Design has no input parameters!")
+        sys.exit(1)
+    existing = np.asarray([[float(x) for x in row[:-1]] for row in rows[1:]], dtype=np.float64)
+    existing = existing.reshape(-1, len(design_names) - 1)
+    if np.any(existing < -1.0) or np.any(existing > 1.0):
+        print("Design has points outside of [-1, 1]")
+        sys.exit(1)
+    repeats = argv.repeats if argv.repeats is not None else (rows[-1][-1] if len(rows) > 1 else "1")
+
+    try:
+        if argv.variance:
+            with open(argv.variance) as variance_file:
+                table = list(csv.DictReader(variance_file))
+            if not table:
+                print("Variance table is empty")
+                sys.exit(1)
+            missing = [x for x in design_names[:-1] + [argv.variance_column] if x not in table[0]]
+            if missing:
+                print(f"Variance table is missing the columns {', '.join(missing)}")
+                sys.exit(1)
+            points = np.asarray([[float(row[x]) for x in design_names[:-1]] for row in table], dtype=np.float64)
+            if np.any(points < -1.0) or np.any(points > 1.0):
+                print("Variance table has points outside of [-1, 1], it must be on the design hypercube")
+                sys.exit(1)
+            variances = np.asarray([float(row[argv.variance_column]) for row in table], dtype=np.float64)
+            new_points = extend_by_variance(existing, points, variances, argv.points, argv.min_distance,
+                                            argv.block_size)
+        else:
+            new_points = extend_maximin(existing, argv.points, argv.candidates, argv.seed,
+                                        block_size=argv.block_size)
+    except ValueError as error:
+        print(str(error))
+        sys.exit(1)
+    except IOError as error:
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
+        sys.exit(1)
+
+    # Copy the existing design exactly, then add the new rows
+    str_mode = 'x'
+    if argv.force:
+        str_mode = "w"
+    try:
+        with open(out_location, str_mode, newline='') as out_file:
+            out_file.write(design_text)
+            if design_text and not design_text.endswith("\n"):
+                out_file.write("\n")
+            csv.writer(out_file).writerows([[repr(float(x)) for x in row] + [repeats] for row in new_points])
+    except FileExistsError:
+        print("Extended design already exists, use -f to force overwriting")
+        sys.exit(1)
+    except IOError as error:
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
+        sys.exit(1)
+
+    first, last = existing.shape[0], existing.shape[0] + new_points.shape[0] - 1
+    print(f"Added {new_points.shape[0]} points to {existing.shape[0]}, the new design indices are {first}-{last}")
+    print(f"Smallest distance between any two points: {min_pairwise_distance(np.vstack([existing, new_points])):.6f}")
+    print(f"Run pre on {out_location} then only the new lines, e.g. metawards -l {first}-{last}")
+    print("Done! See output in " + str(out_location))
+    sys.exit(0)
+
+
+#
+# This arg parser is wrapped in a function for testing purposes
+#
+def main_parser(main_args=None):
+    parser = argparse.ArgumentParser("extend")
+    parser.add_argument('design', metavar='<design file>', type=str, help="Existing design hypercube")
+    parser.add_argument('output', metavar='<output file>', type=str, help="Extended design hypercube")
+    parser.add_argument('-n', '--points', type=int, required=True, help="Number of points to add")
+    parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
+    parser.add_argument('-r', '--repeats', type=str, default=None,
+                        help="Repeats for the new points, the same as the last existing point by default")
+    parser.add_argument('-v', '--variance', type=str, default=None,
+                        help="Emulator variance table to pick the new points from (design variables on [-1, 1])")
+    parser.add_argument('--variance-column', type=str, default="variance", help="Variance column in the table")
+    parser.add_argument('--min-distance', type=float, default=0.0,
+                        help="Skip variance table points this close to the design")
+    parser.add_argument('--candidates', type=int, default=None,
+                        help="Candidate points for the maximin search, 100 per new point by default (at least 1000)")
+    parser.add_argument('-s', '--seed', type=int, default=None, help="Random seed for the maximin candidates")
+    parser.add_argument('--block-size', type=int, default=1024, help="Points per block of distances")
+    return parser.parse_args(main_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#
+# Merge the per-process SQLite shards written by the sql extractors into a single ensemble database
+#
+
+import argparse
+import sys
+import os
+import sqlite3 as sql
+from uq4metawards.sql import ensemble_database_name, find_shards, merge_shards, remove_shard
+
+
+# NOTE: If you use argv as a parameter to main, you will have problems with the package setup entry points
+def main():
+    argv = main_parser()
+
+    data_location = argv.data
+    database_location = argv.output if argv.output else os.path.join(data_location, ensemble_database_name)
+    mode_str = "x"
+    if argv.force:
+        mode_str = "w"
+        print("force option passed, database will be over-written if it exists")
+
+    try:
+        shard_files = find_shards(data_location)
+        if not shard_files:
+            print(f"No database shards found in {data_location}")
+            sys.exit(1)
+        print(f"Merging {len(shard_files)} shard(s) into {database_location}")
+        merge_shards(database_location, shard_files, mode_str)
+
+        # Only tidy up once everything has been copied
+        if argv.remove:
+            for shard_file in shard_files:
+                remove_shard(shard_file)
+            print("Removed shards")
+
+    except FileExistsError:
+        print("Output already exists, use -f to force overwriting")
+        sys.exit(1)
+    except FileNotFoundError as error:
+        print(str(error.filename) + " not found.")
+        sys.exit(1)
+    except (ValueError, sql.Error) as error:
+        print("Merge failed: " + str(error))
+        sys.exit(1)
+    except IOError as error:
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
+        sys.exit(1)
+
+    print("Done! See output at " + str(database_location))
+    sys.exit(0)
+
+
+#
+# This arg parser is wrapped in a function for testing purposes
+#
+def main_parser(main_args=None):
+    parser = argparse.ArgumentParser("merge")
+    parser.add_argument('data', metavar='<data folder>', type=str, help="MetaWards output folder holding the shards")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=f"Merged database, defaults to {ensemble_database_name} in the data folder")
+    parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
+    parser.add_argument('-r', '--remove', action='store_true', help="Delete the shards once they are merged")
+    return parser.parse_args(main_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#
+# Pack the run trajectories of a MetaWards ensemble into a single columnar store that uq4 can read directly
+# Optionally a memory-mapped cube is built from the store as well, for random access from Python
+#
+
+import argparse
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import List
+from uq4metawards.utils import load_csv
+from uq4metawards.utils import print_progress_bar
+from uq4metawards.ensemble import list_ensemble_runs, load_ward_trajectory
+from uq4metawards.store import write_store, EnsembleStore
+from uq4metawards.cube import write_cube_from_store
+
+
+# NOTE: If you use argv as a parameter to main, you will have problems with the package setup entry points
+def main():
+    argv = main_parser()
+
+    design_location = argv.design
+    disease_location = argv.disease
+    data_location = argv.data
+    store_location = argv.store
+    mode_str = "x"
+    if argv.force:
+        mode_str = "w"
+        print("force option passed, store will be over-written if it exists")
+    if argv.jobs < 1:
+        print("Need at least one job to process the runs")
+        sys.exit(1)
+
+    try:
+        with open(design_location) as design_file, \
+                open(disease_location) as disease_file:
+            design_array, design_header_names = load_csv(design_file)
+            disease_array, disease_header_names = load_csv(disease_file)
+        sub_dir_list: List[str] = next(os.walk(data_location))[1]
+        runs = list_ensemble_runs(design_array, disease_array, sub_dir_list)
+        wards_folders: List[str] = [os.path.join(data_location, x[2]) for x in runs]
+
+        # Trajectories are loaded in parallel if asked but written one at a time, in design order
+        str_prefix = "Packing runs"
+        print_progress_bar(0, len(runs), str_prefix, "completed")
+        with ProcessPoolExecutor(max_workers=argv.jobs) if argv.jobs > 1 else nullcontext() as pool:
+            trajectories = pool.map(load_ward_trajectory, wards_folders) if pool is not None \
+                else map(load_ward_trajectory, wards_folders)
+
+            def report(items):
+                for i, item in enumerate(items):
+                    print_progress_bar(i + 1, len(runs), str_prefix, "completed")
+                    yield item
+
+            write_store(store_location, runs, report(trajectories), argv.day_chunk, argv.ward_chunk, mode_str)
+
+        # The cube is filled from the store rather than re-reading every CSV
+        if argv.cube:
+            print(f"Building memory-mapped cube {argv.cube}")
+            with EnsembleStore(store_location) as store:
+                write_cube_from_store(argv.cube, store, mode_str)
+
+    except FileExistsError:
+        print("Output already exists, use -f to force overwriting")
+        sys.exit(1)
+    except FileNotFoundError as error:
+        print(str(error.filename) + " not found.")
+        sys.exit(1)
+    except IOError as error:
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
+        sys.exit(1)
+
+    print("Done! See output at " + str(store_location))
+    sys.exit(0)
+
+
+#
+# This arg parser is wrapped in a function for testing purposes
+#
+def main_parser(main_args=None):
+    parser = argparse.ArgumentParser("pack")
+    parser.add_argument('design', metavar='<input design file>', type=str, help="Input design matrix")
+    parser.add_argument('disease', metavar='<input disease file>', type=str, help="Input disease matrix")
+    parser.add_argument('data', metavar='<data folder>', type=str, help="MetaWards output folder")
+    parser.add_argument('store', metavar='<store file>', type=str, help="Output ensemble store")
+    parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes used to load the runs")
+    parser.add_argument('-c', '--cube', type=str, default=None,
+                        help="Also build a memory-mapped (runs, days, wards) cube at this location")
+    parser.add_argument('--day-chunk', type=int, default=32, help="Days per stored chunk")
+    parser.add_argument('--ward-chunk', type=int, default=1024, help="Wards per stored chunk")
+    return parser.parse_args(main_args)
+
+
+if __name__ == '__main__':
+    main()
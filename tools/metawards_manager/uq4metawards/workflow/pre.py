@@ -9,7 +9,9 @@ import os
 import argparse
 import csv
 from typing import List
-from uq4metawards.utils import transform_epidemiological_to_disease, select_dictionary_keys
+from contextlib import ExitStack
+from uq4metawards.utils import transform_epidemiological_to_disease_array, select_dictionary_keys
+from uq4metawards.utils import iterate_chunks, iterate_csv_body
 from uq4metawards.sql import make_design_table_schema
 from configparser import ConfigParser
 from sqlite3 import connect, Cursor, Connection
@@ -89,6 +91,31 @@ def make_design_table_schema(primary_key: str, design_vars: List[str], design_ta
     return f'create table {design_table_name} ( {table_entries} );'
 
 
+# Rescale a chunk of hypercube rows on [-1, 1] and transform them to disease parameters
+# Returns the disease and epidemiology rows as strings ready to hand to a csv writer
+def transform_design_chunk(rows: List[List[str]], first_index: int, col_indices: List[int],
+                           minimums: List[float], maximums: List[float]) -> (List[List[str]], List[List[str]]):
+    hypercubes = [[float(x) for x in row[:-1]] for row in rows]
+    hyper_scales = []
+    for hypercube in hypercubes:
+        hyper_01 = [(x / 2.0) + 0.5 for x in hypercube]
+        hyper_scales.append([(x * (maximums[col_indices[i]] - minimums[col_indices[i]])) + minimums[col_indices[i]]
+                             for i, x in enumerate(hyper_01)])
+    disease_columns = [[x[col_indices[k]] for x in hyper_scales] for k in range(3)]
+    all_metawards_params = transform_epidemiological_to_disease_array(*disease_columns).tolist() \
+        if hyper_scales else []
+
+    disease_rows: List[List[str]] = []
+    epidemiology_rows: List[List[str]] = []
+    for i, row in enumerate(rows):
+        # Design key, hypercube, then metawards parameters and repeats
+        key = [str(first_index + i)]
+        epidemiology_rows.append(key + [str(x) for x in hyper_scales[i]] + [str(row[-1])])
+        disease_rows.append(key + [str(x) for x in hypercubes[i]] + [str(x) for x in all_metawards_params[i]] +
+                            [str(row[-1])])
+    return disease_rows, epidemiology_rows
+
+
 def main():
     args = main_parser()
 
@@ -96,16 +123,18 @@ def main():
     scales_location: str = args.scales
     disease_location: str = args.disease
 
-    # Grab data from disk
+    if args.chunk_size < 1:
+        print("Chunk size must be positive")
+        sys.exit(1)
+
+    # Grab the headers from disk, the design itself is streamed through in chunks further down
     try:
         with open(design_location) as design_file, \
                 open(scales_location) as scales_file:
 
-            design_data: List[List[str]] = list(csv.reader(design_file))
+            design_names: List[str] = next(csv.reader(design_file), [])
             scales_data: List[List[str]] = list(csv.reader(scales_file))
 
-            design_names: List[str] = design_data[0]
-            design_data.pop(0)
             scales_names: List[str] = scales_data[0]
             scales_data.pop(0)
 
@@ -116,7 +145,6 @@ def main():
     # Check that the designs are the right size to scale and all scale vars have been defined
     n_design_columns = len(design_names)
     n_scale_columns = len(scales_names)
-    n_design_points = len(design_data)
 
     # We need at least 2 columns for a valid design
     if n_design_columns < 2:
@@ -161,74 +189,55 @@ def main():
                                      "repeats"
                                  ]
 
-    n_epidemiology_columns = len(epidemiology_headers)
-    n_disease_columns = len(disease_headers)
-    epidemiology_table = [[''] * n_epidemiology_columns] * n_design_points
-    disease_table = [[''] * n_disease_columns] * n_design_points
-
-    # Iterate down the design table and rescale as needed
-    for i, row in enumerate(design_data):
-        hypercube = [float(x) for x in row[:-1]]
-        hyper_01 = [(x / 2.0) + 0.5 for x in hypercube]
-        hyper_scale = [(x * (maximums[col_indices[i]] - minimums[col_indices[i]])) + minimums[col_indices[i]]
-                       for i, x in enumerate(hyper_01)]
-        metawards_params = list(transform_epidemiological_to_disease(hyper_scale[col_indices[0]],
-                                                                     hyper_scale[col_indices[1]],
-                                                                     hyper_scale[col_indices[2]]))
-
-        disease_row = [''] * n_disease_columns
-        epidemiology_row = [''] * n_epidemiology_columns
-
-        # Design keys
-        epidemiology_row[0:len(key_names)] = [str(i)]
-        disease_row[0:len(key_names)] = [str(i)]
-
-        # Hypercubes
-        epidemiology_row[len(key_names):len(key_names) + len(hyper_scale)] = [str(x) for x in hyper_scale]
-        disease_row[len(key_names):len(key_names) + len(hypercube)] = [str(x) for x in hypercube]
-
-        # Metawards parameters
-        epidemiology_row[len(key_names) + len(hyper_scale):] = str(row[-1])
-        disease_row[len(key_names) + len(hyper_scale):] = [str(x) for x in metawards_params] + [str(row[-1])]
-
-        epidemiology_table[i] = epidemiology_row
-        disease_table[i] = disease_row
-
-    epidemiology_table.insert(0, epidemiology_headers)
-    disease_table.insert(0, disease_headers)
-
-    # Write output disease table
+    # Write the output tables a chunk at a time so memory use doesn't depend on the size of the design
     str_mode = 'x'
     if args.force:
         str_mode = "w"
 
+    in_name, in_ext = os.path.splitext(disease_location)
+    e_name = in_name + "_epidemiology.csv"
+
+    # Both outputs are opened before anything is written, if one already exists then any made here are removed
+    n_design_points: int = 0
+    created: List[str] = []
     try:
-        with open(disease_location, str_mode, newline='') as disease_file:
-            writer = csv.writer(disease_file)
-            writer.writerows(disease_table)
-    except FileExistsError:
-        print("Disease table already exists, use -f to force overwriting")
+        with open(design_location) as design_file, ExitStack() as out_files:
+            disease_file = out_files.enter_context(open(disease_location, str_mode, newline=''))
+            created.append(disease_location)
+            e_file = None
+            if args.epidemiology:
+                e_file = out_files.enter_context(open(e_name, str_mode, newline=''))
+                created.append(e_name)
+
+            disease_writer = csv.writer(disease_file)
+            disease_writer.writerow(disease_headers)
+            epidemiology_writer = None
+            if e_file is not None:
+                epidemiology_writer = csv.writer(e_file)
+                epidemiology_writer.writerow(epidemiology_headers)
+
+            design_reader = csv.reader(design_file)
+            next(design_reader, None)
+            for chunk in iterate_chunks(design_reader, args.chunk_size):
+                disease_rows, epidemiology_rows = \
+                    transform_design_chunk(chunk, n_design_points, col_indices, minimums, maximums)
+                disease_writer.writerows(disease_rows)
+                if epidemiology_writer is not None:
+                    epidemiology_writer.writerows(epidemiology_rows)
+                n_design_points += len(chunk)
+
+    except FileExistsError as error:
+        for x in created:
+            os.remove(x)
+        if error.filename == e_name:
+            print("Epidemiology table already exists, use -f to force overwriting")
+        else:
+            print("Disease table already exists, use -f to force overwriting")
         sys.exit(1)
     except IOError as error:
-        print("File system error: " + str(error.msg) + " when operating on " + str(error.filename))
+        print("File system error: " + str(error.strerror) + " when operating on " + str(error.filename))
         sys.exit(1)
 
-
-    # Write epidemiology table
-    if args.epidemiology:
-        in_name, in_ext = os.path.splitext(disease_location)
-        e_name = in_name + "_epidemiology.csv"
-        try:
-            with open(e_name, str_mode, newline='') as e_file:
-                writer = csv.writer(e_file)
-                writer.writerows(epidemiology_table)
-        except FileExistsError:
-            print("Epidemiology table already exists, use -f to force overwriting")
-            sys.exit(1)
-        except IOError as error:
-            print("File system error: " + str(error.msg) + " when operating on " + str(error.filename))
-            sys.exit(1)
-
     # Write database
     if args.remote:
 
@@ -279,7 +288,7 @@ def main():
             cur.execute(qstring)
 
             # Send design data
-            for i, row in enumerate(design_data):
+            for i, row in enumerate(iterate_csv_body(design_location)):
                 data = [float(x) for x in row[:-1]]
                 qstring = f"INSERT INTO design ({','.join(['design_index'] + design_names[:-1])}) " \
                           f"VALUES ({','.join(['%s']*(len(design_names[:-1])+1))})"
@@ -308,7 +317,7 @@ def main():
 
 
         # Make database
-        make_memory_database([key_names[0][1:]] + design_names, design_data, None)
+        make_memory_database([key_names[0][1:]] + design_names, iterate_csv_body(design_location), None)
 
         # Create a valid URI to use the SQLite access rights
         data_base_file_name: str = os.path.join(os.path.dirname(disease_location), "sql_wards.dat")
@@ -332,6 +341,7 @@ def main_parser(main_args=None):
     parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
     parser.add_argument('-e', '--epidemiology', action='store_true', help="Output epidemiology matrix")
     parser.add_argument('-r', '--remote', nargs=1, type=str, help="Remote database configuration file")
+    parser.add_argument('-c', '--chunk-size', type=int, default=10000, help="Design rows to process at a time")
     return parser.parse_args(main_args)
 
 
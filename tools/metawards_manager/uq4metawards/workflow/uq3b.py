@@ -3,17 +3,43 @@
 #
 # 28/05/20: Changed to pass information through metawards to reduce the post-processing steps
 # Also removed the need for numpy
+# The disease transform works on whole columns at once, so numpy is used inside utils
 #
 
 import sys
 import argparse
 import csv
 from typing import List, Any
-from uq4metawards.utils import transform_epidemiological_to_disease
+from uq4metawards.utils import transform_epidemiological_to_disease_array, iterate_chunks
+
+
+# Transform a chunk of epidemiology rows into stringified disease rows, keyed from first_index onwards
+def transform_epidemiology_chunk(rows: List[List[str]], first_index: int) -> List[List[str]]:
+
+    # Data-type conversion
+    design_values: List[List[float]] = [[float(x) for x in row[:-1]] for row in rows]
+    repeats: List[int] = [int(float(row[-1])) for row in rows]
+
+    # Only pass the first three fields to the disease builder, a column at a time
+    # TODO: Do this by name rather than assuming order?
+    columns = list(zip(*design_values))[0:3]
+    disease_params: List[List[float]] = transform_epidemiological_to_disease_array(*columns).tolist()
+
+    # Unique design key, scale rates passed through, disease parameters then repeats
+    disease_rows: List[List[str]] = []
+    for i, values in enumerate(design_values):
+        new_row: List[Any] = [first_index + i] + values + disease_params[i] + [repeats[i]]
+
+        # Stringify it for csv writing
+        disease_rows.append([str(x) for x in new_row])
+    return disease_rows
 
 
 def main():
     argv = main_parser()
+    if argv.chunk_size < 1:
+        print("Chunk size must be positive")
+        sys.exit(1)
 
     # Query the parser - is getattr() safer?
     in_location: str = argv.input
@@ -28,9 +54,11 @@ def main():
         with open(in_location) as epidemiology_file_handle, \
                 open(out_location, mode_str, newline='') as disease_file:
 
-            epidemiology_file: List[List[str]] = list(csv.reader(epidemiology_file_handle))
-            epidemiology_header_names: List[str] = epidemiology_file[0]
-            epidemiology_file.pop(0)
+            epidemiology_file = csv.reader(epidemiology_file_handle)
+            epidemiology_header_names: List[str] = next(epidemiology_file, [])
+            if not epidemiology_header_names:
+                print("Epidemiology matrix is empty!")
+                sys.exit(1)
 
             # Turn the original design variables into custom variables for metawards
             # Ignore the repeats column
@@ -53,36 +81,13 @@ def main():
                                         "repeats"
                                     ]
 
-            # Only pass the first three fields to the disease builder
-            # TODO: Do this by name rather than assuming order?
-            disease_matrix: List[List[str]] = [[''] * len(head_names)] * len(epidemiology_file)
-            for i, _ in enumerate(disease_matrix):
-                row: List[Any] = epidemiology_file[i]
-
-                # Data-type conversion
-                row[:-1] = [float(x) for x in row[:-1]]
-                row[-1] = int(float(row[-1]))
-                new_row: List[Any] = [0] * len(head_names)
-
-                # Create a unique design key
-                write_pos: int = len(key_names)
-                new_row[0:write_pos] = [i]
-
-                # Pass scale rates and repeats through from epidemiology file
-                new_row[write_pos:write_pos + len(e_names)] = row[0:-1]
-                new_row[-1] = row[-1]
-                write_pos += len(e_names)
-
-                # Transform the other parameters to disease parameters
-                new_row[write_pos:len(head_names) - 1] = \
-                    list(transform_epidemiological_to_disease(row[0], row[1], row[2]))
-
-                # Stringify it for csv writing
-                disease_matrix[i] = [str(x) for x in new_row]
-
-            disease_matrix.insert(0, head_names)
+            # Stream the matrix through in chunks so memory use doesn't grow with the number of design points
             writer = csv.writer(disease_file)
-            writer.writerows(disease_matrix)
+            writer.writerow(head_names)
+            n_rows: int = 0
+            for chunk in iterate_chunks(epidemiology_file, argv.chunk_size):
+                writer.writerows(transform_epidemiology_chunk(chunk, n_rows))
+                n_rows += len(chunk)
 
     except FileExistsError:
         print("Output already exists, use -f to force overwriting")
@@ -106,6 +111,7 @@ def main_parser(main_args=None):
     parser.add_argument('input', metavar='<input file>', type=str, help="Input epidemiology matrix")
     parser.add_argument('output', metavar='<output file>', type=str, help="Output disease matrix")
     parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
+    parser.add_argument('-c', '--chunk-size', type=int, default=10000, help="Matrix rows to process at a time")
     return parser.parse_args(main_args)
 
 
@@ -5,14 +5,100 @@
 import argparse
 import sys
 import os
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import List, Optional, Set, Tuple, Union
 from uq4metawards.utils import load_csv
 from uq4metawards.utils import print_progress_bar
-from uq4metawards.utils import create_fingerprint
+from uq4metawards.aggregate import WardAggregator
+from uq4metawards.ensemble import list_ensemble_runs, load_ward_trajectory, find_ward_trajectory
+from uq4metawards.store import EnsembleStore
 import pandas as pd
 import numpy as np
 
 
+# Turn a day specification into a sorted list of days, e.g. "80,133,152", "60-150" or a mix of both
+# "all" returns None, meaning every day that any of the runs reached
+def parse_day_list(text: str) -> Optional[List[int]]:
+    if text.strip().lower() == "all":
+        return None
+    days: Set[int] = set()
+    for item in text.split(","):
+        item = item.strip()
+        # The first character is skipped when looking for a range so that negative days are reported as such
+        if "-" in item[1:]:
+            split = item.index("-", 1)
+            first, last = int(item[:split]), int(item[split + 1:])
+            if last < first:
+                raise ValueError(f"Day range {item} runs backwards")
+            days.update(range(first, last + 1))
+        else:
+            days.add(int(item))
+    if not days:
+        raise ValueError("No days given")
+    if min(days) < 0:
+        raise ValueError("Can't extract a negative day")
+    return sorted(days)
+
+
+# Stores opened by this process, kept open across runs so the index is only read once
+# NOTE: These are keyed on the process ID as forked workers must not share the parent's file handle
+_stores: dict = {}
+
+
+def _open_store(store_file: str) -> EnsembleStore:
+    key = (os.getpid(), store_file)
+    if key not in _stores:
+        _stores[key] = EnsembleStore(store_file)
+    return _stores[key]
+
+
+# Load a single run, aggregate it to local authorities and pull out the requested days
+# This lives at module level so that it can be handed to a process pool; it must not print or touch shared state
+# Returns the ward and LAD values on each day, their cumulative sums up to each day and the last day in the run
+# Days past the end of the run are substituted with zeros (and the cumulative sums stop growing)
+# If days is None then every day in the run is returned
+# The run is either a MetaWards output folder or a (store file, run) pair, stores are only read up to the last day
+def process_run(run_source: Union[str, Tuple[str, int]], days: Optional[List[int]], lads: WardAggregator) \
+        -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, int):
+    if isinstance(run_source, str):
+        trajectory = load_ward_trajectory(run_source)
+        max_day_available: int = trajectory.shape[0] - 1
+    else:
+        store = _open_store(run_source[0])
+        read_days = slice(None) if days is None else slice(0, days[-1] + 1)
+        trajectory = store.read(run_source[1], days=read_days).astype(np.int64)
+        max_day_available: int = store.n_days(run_source[1]) - 1
+
+    # Create an aggregated LAD table for every day in one go
+    lad_entry = lads(trajectory)
+
+    # Find the limit of the disease time-span
+    if days is None:
+        days = list(range(max_day_available + 1))
+    index = np.minimum(np.asarray(days, dtype=int), max_day_available)
+    missing = np.asarray(days, dtype=int) > max_day_available
+
+    # Only accumulate as far as the last day that is needed
+    last = int(index.max()) + 1
+    wards_cumulative = np.cumsum(trajectory[0:last], 0)[index]
+    lads_cumulative = np.cumsum(lad_entry[0:last], 0)[index]
+    wards_days = trajectory[index]
+    wards_days[missing] = 0
+    lads_days = lad_entry[index]
+    lads_days[missing] = 0
+    return wards_days, lads_days, wards_cumulative, lads_cumulative, max_day_available
+
+
+# Stick the design variables on the front of a table of values (one row per run) and write it out
+def write_day_table(file_name: str, design: np.ndarray, design_names: List[str], values: np.ndarray,
+                    value_names: List[str]):
+    frame = pd.concat([pd.DataFrame(data=design, columns=design_names),
+                       pd.DataFrame(data=values, columns=value_names)], axis=1)
+    frame.to_csv(file_name, index=False)
+
+
 # NOTE: If you use argv as a parameter to main, you will have problems with the package setup entry points
 def main():
     argv = main_parser()
@@ -31,13 +117,23 @@ def main():
     # NOTE: Lockdown 1 = day 80, Lockdown 2 = day 133, 1st june = 152
     #
     # We want cumulative for each, rates for each (differences)
+    # All of these can be pulled out in one go, e.g. uq4 ... 80,133,152
     #
 
-    if argv.day < 0:
-        print("Can't extract a negative day")
+    try:
+        days: Optional[List[int]] = parse_day_list(argv.days)
+    except ValueError as error:
+        print(f"Invalid day list {argv.days}: {error}")
+        sys.exit(1)
+    if argv.jobs < 1:
+        print("Need at least one job to process the runs")
+        sys.exit(1)
+    if argv.day_block < 1:
+        print("Need at least one day per block")
         sys.exit(1)
 
-    str_prefix = f"Building day tables for day {argv.day}"
+    day_str = "all days" if days is None else "day " + argv.days
+    str_prefix = f"Building day tables for {day_str}"
     str_suffix = f"completed"
 
     # Touch the file system - keep the handles as long as possible in case of threads / processes interfering
@@ -52,151 +148,84 @@ def main():
             design_array, design_header_names = load_csv(design_file)
             disease_array, disease_header_names = load_csv(disease_file)
             ward_data = pd.read_csv(ward_lookup_file, quotechar='"')
-            sub_dir_list: List[str] = next(os.walk(data_location))[1]
+            if argv.store:
+                sub_dir_list: List[str] = [x[2] for x in _open_store(argv.store).runs]
+                print(f"Reading runs from store {argv.store}")
+            else:
+                sub_dir_list: List[str] = next(os.walk(data_location))[1]
 
             print("Loaded design table - fields: " + ','.join(design_header_names))
             print("Loaded disease table - fields: " + ','.join(disease_header_names))
 
             # Build output frame column names
             n_wards: int = ward_data.shape[0]
-            col_names: List[str] = design_header_names[0:len(design_header_names) - 1]
+            design_names: List[str] = design_header_names[0:len(design_header_names) - 1]
             ward_cols: List[str] = [f"ward[{x + 1}]" for x in range(n_wards)]
-            col_names += ward_cols
-
-            # Collect the local authorities into groups (of indices)
-            lads: dict = ward_data.groupby("LAD11NM").groups
-            col_names_lads: List[str] = design_header_names[0:len(design_header_names) - 1]
-            lads_cols: List[str] = [str(x) for x in lads]
-            col_names_lads += lads_cols
-
-            # ids = ward_data["FID"].values
-            # lads = ward_data["LAD11NM"].values
-
-            # Calculate number of size of the output frames
-            n_experiments = int(sum(design_array[:, design_array.shape[1] - 1]))
-            large_frame_width = len(col_names)
-            small_frame_width = len(col_names_lads)
-
-            # Day, Date, Design vars (no repeats), Wards
-            # n_cols = 2 + (disease_file.shape[1] - 1) + n_wards
-
-            # Fiddling with lists is cheaper than messing with dataframes
-            all_wards_i_per_day = [[None] * large_frame_width] * n_experiments
-            all_lads_i_per_day = [[None] * small_frame_width] * n_experiments
-            all_wards_i_cumulative = [[None] * large_frame_width] * n_experiments
-            all_lads_i_cumulative = [[None] * small_frame_width] * n_experiments
-
-            experiment_index: int = 0
-            print("Loading data from MetaWards...")
-            print_progress_bar(experiment_index, n_experiments, str_prefix, str_suffix)
-
-            # We iterate collectively over both files as the outputs requires metawards variables
-            # but the stats output requires design varaiables
-            for design_row, disease_row in zip(enumerate(design_array), enumerate(disease_array)):
-
-                # Calculate how many runs match this design
-                design_vars = design_row[1][0:len(design_row[1]) - 1].tolist()
-                metawards_vars = disease_row[1][0:len(disease_row[1]) - 1].tolist()
-                repeats: int = int(design_row[1][len(design_row[1]) - 1])
-
-                # Check that repeats is valid
-                if repeats < 1:
-                    raise ValueError("Invalid number of repeats, design file might be corrupted")
-
-                # Try to find each output folder using metawards variable fingerprint
-                for r in range(repeats):
-                    string: str = create_fingerprint(metawards_vars, r + 1, True)
-                    if string not in sub_dir_list:
-                        raise ValueError("Missing run data for: " + string)
-
-                    wards_folder: str = os.path.join(data_location, string)
-                    wards_file: str = os.path.join(wards_folder, "wards_trajectory_I.csv.bz2")
-
-                    # Load the ward data (drop ward[0] as it is a placeholder)
-                    # We need to use pandas as there is more than one datatype in the output
-                    # Drop the day and date (not needed), then also ward[0] as it isn't a ward
-                    mw_out = pd.read_csv(wards_file).drop(["ward[0]", "date", "day"], 1)
-
-                    # NOTE: ANSI escape characters don't work in Windows Python implementations at the moment
-                    print(f"\rLoaded: {wards_file}")
-
-                    # Create an aggregated LAD table
-                    # NOTE: This is a silly slow way of doing it, but will do for now
-                    num_authorities = len(lads)
-                    print_progress_bar(0, num_authorities - 1, "Aggregating local authorities", str_suffix)
-                    lad_entry = np.zeros((mw_out.shape[0], num_authorities), dtype=int)
-                    for i, indices in enumerate(lads.values()):
-                        fids = ward_data.loc[indices, ["FID"]].values.squeeze()
-                        col_strings = [f"ward[{x}]" for x in fids]
-                        entry = mw_out[col_strings].values
-                        lad_entry[:, i] = np.sum(entry, 1).reshape(1, -1)
-                        print_progress_bar(i, num_authorities - 1, "Aggregating local authorities", str_suffix,
-                                           newline_end=False)
-
-                    # Find the limit of the disease time-span
-                    max_day_available: int = mw_out.shape[0] - 1
-                    if argv.day > max_day_available:
-
-                        # If a day is missing, return zeros
-                        print(f"Run: {wards_file} has no day {argv.day} - it will be substituted with zeros")
-                        # NOTE: PyCharm doesn't like the type of the indexer here, but it is int?
-                        all_wards_i_per_day[experiment_index] = [0] * large_frame_width
-                        all_lads_i_per_day[experiment_index] = [0] * small_frame_width
-
-                        wards_cumulative = mw_out.values.squeeze().tolist()
-                        lads_cumulative = lad_entry
-                        remaining = argv.day - max_day_available
-
-                        null_row = design_vars + list([0] * (large_frame_width - len(design_vars)))
-                        wards_remaining: List[List[int]] = [null_row] * remaining
-
-                        null_row = design_vars + list([0] * (small_frame_width - len(design_vars)))
-                        lads_remaining = np.broadcast_to(np.asarray(null_row), (remaining, small_frame_width))
-                        cumulative_wards_row = wards_cumulative + wards_remaining
-                        cumulative_lads_row = np.vstack((lads_cumulative, lads_remaining))
-                    else:
-
-                        # Instant
-                        wards_row = mw_out.iloc[[argv.day]].values.squeeze().tolist()[7:]
-                        data_row = design_vars + wards_row
-                        all_wards_i_per_day[experiment_index] = data_row
-
-                        # Instant LAD
-                        lad_row = lad_entry[argv.day, :].tolist()
-                        data_row = design_vars + lad_row
-                        all_lads_i_per_day[experiment_index] = data_row
-
-                        # Cumulative
-                        cumulative_wards_row = mw_out.iloc[0:argv.day + 1].values.squeeze().tolist()
-                        cumulative_lads_row = lad_entry[0:argv.day + 1, :]
-                        extra_bits = np.broadcast_to(np.asarray(design_vars).reshape(1, -1),
-                                                     (cumulative_lads_row.shape[0], len(design_vars)))
-                        cumulative_lads_row = np.hstack((extra_bits, cumulative_lads_row))
-
-                    # TODO: Pointless sum of inputs
-                    all_wards_i_cumulative[experiment_index] = [sum(i) for i in zip(*cumulative_wards_row)]
-                    all_wards_i_cumulative[experiment_index][0:7] = design_vars
-
-                    temp = np.sum(cumulative_lads_row, 0)
-                    temp[0:len(design_vars)] = design_vars
-                    all_lads_i_cumulative[experiment_index] = temp
-
-                    experiment_index += 1
-                    print_progress_bar(experiment_index, n_experiments, str_prefix, str_suffix)
-
-            print("Building output frames...")
-            w_out_by_day_full = pd.DataFrame(data=all_wards_i_per_day, columns=col_names)
-            w_out_by_day_full.to_csv(os.path.join(data_location, f"wards_by_day_{argv.day}.csv"), index=False)
-
-            w_out_by_day_cumulative = pd.DataFrame(data=all_wards_i_cumulative, columns=col_names)
-            w_out_by_day_cumulative.to_csv(os.path.join(data_location, f"wards_by_day_cumulative_{argv.day}.csv"),
-                                           index=False)
-
-            lad_out_by_day_full = pd.DataFrame(data=all_lads_i_per_day, columns=col_names_lads)
-            lad_out_by_day_full.to_csv(os.path.join(data_location, f"lads_by_day_{argv.day}.csv"), index=False)
-
-            lad_out_by_day_cumulative = pd.DataFrame(data=all_lads_i_cumulative, columns=col_names_lads)
-            lad_out_by_day_cumulative.to_csv(os.path.join(data_location, f"lads_by_day_cumulative_{argv.day}.csv"), index=False)
+
+            # Build the ward to local authority operator once, it is shared by every run
+            lads = WardAggregator(ward_data, "LAD11NM")
+            lads_cols: List[str] = lads.names
+
+            # Find every run folder up front, in design order
+            runs = list_ensemble_runs(design_array, disease_array, sub_dir_list)
+            n_experiments = len(runs)
+            wards_folders: List[str] = [os.path.join(data_location, x[2]) for x in runs]
+            if argv.store:
+                run_sources = [(argv.store, _open_store(argv.store).find_run(x[2])) for x in runs]
+            else:
+                run_sources = wards_folders
+            run_design = design_array[[x[0] for x in runs], 0:design_array.shape[1] - 1]
+
+            print(f"Loading data from MetaWards using {argv.jobs} job(s), {argv.day_block} day(s) at a time...")
+
+            # The days are done a block at a time so that memory doesn't grow with the number of days, every run is
+            # read once per block and that block's tables are written before moving on
+            # Runs are loaded in parallel if asked, but map() always hands the results back in design order
+            # so the output is the same however many jobs are used
+            # Asking for everything means running out to the longest run, found on the first block
+            tables = [("wards_by_day", 0, ward_cols),
+                      ("lads_by_day", 1, lads_cols),
+                      ("wards_by_day_cumulative", 2, ward_cols),
+                      ("lads_by_day_cumulative", 3, lads_cols)]
+            block_days: List[int] = days[:argv.day_block] if days is not None else list(range(argv.day_block))
+            n_done: int = 0
+            with ProcessPoolExecutor(max_workers=argv.jobs) if argv.jobs > 1 else nullcontext() as pool:
+                while block_days:
+                    block_prefix = f"{str_prefix} ({block_days[0]}-{block_days[-1]})"
+                    print_progress_bar(0, n_experiments, block_prefix, str_suffix)
+                    run_results: List[tuple] = []
+                    worker = partial(process_run, days=block_days, lads=lads)
+                    results = pool.map(worker, run_sources) if pool is not None else map(worker, run_sources)
+                    for experiment_index, result in enumerate(results):
+                        max_day_available = result[4]
+
+                        # NOTE: ANSI escape characters don't work in Windows Python implementations at the moment
+                        if n_done == 0:
+                            if argv.store:
+                                wards_file = f"{argv.store}::{runs[experiment_index][2]}"
+                            else:
+                                wards_file = find_ward_trajectory(wards_folders[experiment_index])
+                            print(f"\rLoaded: {wards_file}")
+                            if days is not None and days[-1] > max_day_available:
+                                print(f"Run: {wards_file} stops at day {max_day_available} - "
+                                      f"later days will be substituted with zeros")
+
+                        run_results.append(result)
+                        print_progress_bar(experiment_index + 1, n_experiments, block_prefix, str_suffix)
+
+                    if days is None:
+                        days = list(range(max([x[4] for x in run_results], default=-1) + 1))
+
+                    # Days past the end of the longest run aren't written when asking for everything
+                    for day_index, day in enumerate(block_days[:len(days) - n_done]):
+                        for prefix, position, value_names in tables:
+                            values = np.stack([x[position][day_index] for x in run_results]) if run_results else \
+                                np.zeros((0, len(value_names)), dtype=int)
+                            write_day_table(os.path.join(data_location, f"{prefix}_{day}.csv"), run_design,
+                                            design_names, values, value_names)
+
+                    n_done += len(block_days)
+                    block_days = days[n_done:n_done + argv.day_block]
 
             # index_header = ','.join(["key", "folder_id", "design_id", "run_id"])
             # index_matrix = np.asarray(index)
@@ -225,8 +254,14 @@ def main_parser(main_args=None):
     parser.add_argument('disease', metavar='<input disease file>', type=str, help="Input disease matrix")
     parser.add_argument('data', metavar='<data folder>', type=str, help="MetaWards output folder")
     parser.add_argument('lookup', metavar='<ward lookup file>', type=str, help="Ward data lookup file")
-    parser.add_argument('day', metavar='<sim date>', type=int, help="Day to extract")
+    parser.add_argument('days', metavar='<sim days>', type=str,
+                        help="Days to extract, e.g. 80 or 80,133,152 or 60-150, or all")
     parser.add_argument('-f', '--force', action='store_true', help="Force over-write")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes used to load the runs")
+    parser.add_argument('-b', '--day-block', type=int, default=16,
+                        help="Days built per pass over the runs, memory use grows with this")
+    parser.add_argument('-s', '--store', type=str, default=None,
+                        help="Read the runs from an ensemble store (see uq4metawards-pack) instead of the data folder")
     return parser.parse_args(main_args)
 
 
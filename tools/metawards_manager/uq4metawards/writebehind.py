@@ -0,0 +1,79 @@
+#
+# Write-behind for the extractors: database work is done on a background thread while the simulation moves on
+#
+# The extractor copies what it needs out of the workspace (a numpy snapshot) and submits it along with the task that
+# writes it. The thread owns the sink (database connection, buffers...), which is made on the thread itself as
+# sqlite and psycopg2 connections should only be used by the thread that opened them
+# The queue is bounded, so if the writer falls behind then submit() blocks rather than piling snapshots up in memory
+#
+
+import queue
+import threading
+from typing import Callable, Union
+
+# Marks the end of the queue
+_stop = object()
+
+
+class WriteBehind:
+    def __init__(self, make_sink: Callable[[], object], max_pending: int = 8, name: str = "uq4covid-writer"):
+        if max_pending < 1:
+            raise ValueError("Need room for at least one pending task")
+        self._make_sink = make_sink
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._error: Union[BaseException, None] = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # The writer thread, tasks are run in the order they were submitted
+    # Once a task fails the rest are skipped (they would be writing against a broken sink) and the error is handed
+    # back to the extractor on every submit() / wait() / close() from then on
+    def _run(self):
+        sink = None
+        try:
+            sink = self._make_sink()
+        except BaseException as error:
+            self._error = error
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _stop:
+                    break
+                if self._error is None:
+                    task, args = item
+                    task(sink, *args)
+            except BaseException as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+        if sink is not None and hasattr(sink, "close"):
+            try:
+                sink.close()
+            except BaseException as error:
+                if self._error is None:
+                    self._error = error
+
+    # NOTE: The error is kept, a failed writer stays failed rather than carrying on with a half written sink
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    # Run task(sink, *args) on the writer thread, blocks while the queue is full
+    # NOTE: Anything passed here must not be changed afterwards, hand over copies of workspace arrays
+    def submit(self, task: Callable, *args):
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise ValueError("The writer has been closed")
+        self._queue.put((task, args))
+
+    # Block until everything submitted so far has been written
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+    # Finish off the queue, close the sink and stop the thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_stop)
+            self._thread.join()
+        self._raise_error()